@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from tools.market_store import TIMESTAMP, MarketStore, to_hour
+
+
+START = datetime(2024, 1, 1)
+
+
+def hourly_columns(start: datetime, hours: int) -> dict:
+    first = to_hour(start)
+    return {
+        TIMESTAMP: np.arange(first, first + hours, dtype=np.int64),
+        "volume": np.arange(hours, dtype=np.float64),
+    }
+
+
+SCHEMA = {"volume": {"kind": "scalar", "type": "float"}}
+
+
+def test_short_fetch_leaves_unpublished_hours_missing(tmp_path):
+    store = MarketStore(str(tmp_path), "binance", "doge-usdt")
+    end = START + timedelta(hours=48)
+    # the provider has published only the first 30 hours of the requested 48
+    store.add(hourly_columns(START, 30), SCHEMA, START, end, now=START + timedelta(hours=31))
+
+    assert store.missing(START, end) == [(START + timedelta(hours=30), end)]
+
+    store = MarketStore(str(tmp_path), "binance", "doge-usdt")
+    store.add(hourly_columns(START + timedelta(hours=30), 18), SCHEMA, START + timedelta(hours=30), end,
+              now=end + timedelta(hours=5))
+    assert store.missing(START, end) == []
+    assert len(store.columns(START, end)[TIMESTAMP]) == 48
+
+
+def test_empty_fetch_of_recent_hours_is_not_covered(tmp_path):
+    store = MarketStore(str(tmp_path), "binance", "doge-usdt")
+    end = START + timedelta(hours=24)
+    store.add(hourly_columns(START, 0), SCHEMA, START, end, now=START + timedelta(hours=1))
+
+    assert store.missing(START, end) == [(START, end)]
+
+
+def test_empty_fetch_of_published_hours_is_covered(tmp_path):
+    store = MarketStore(str(tmp_path), "binance", "doge-usdt")
+    end = START + timedelta(hours=24)
+    store.add(hourly_columns(START, 0), SCHEMA, START, end, now=end + timedelta(days=1))
+
+    assert store.missing(START, end) == []
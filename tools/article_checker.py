@@ -6,10 +6,11 @@ import json
 import os
 import sys
 from github import Github
-from tools.git import get_pull_request, get_diff_by_url, parse_diff
+from tools.git import get_pull_request, get_diff, parse_diff, DIFF_SOURCES, Hunk, CONTENT_GLOB
+from typing import Iterable
 from tools.utils import logging_decorator
 import requests
-import tiktoken
+from tools.tokens import count_tokens, trim_tokens
 
 
 def parse_cli_args():
@@ -26,24 +27,14 @@ def parse_cli_args():
     parser.add_argument(
         "--pull-url", dest="pull_url", help="GitHub pull URL", required=True
     )
+    parser.add_argument(
+        "--diff-source", dest="diff_source", help="Where to get the PR diff from", choices=DIFF_SOURCES, default="url"
+    )
     return parser.parse_args()
 
 
-def count_tokens(text, model_name="gpt-3.5-turbo"):
-    tokenizer = tiktoken.encoding_for_model(model_name)
-    return len(tokenizer.encode(text))
-
-
 def trimming_prompt(prompt, max_tokens):
-    token_count = count_tokens(prompt)
-    trimmed_prompt = prompt
-    while token_count > max_tokens:
-        tokens = trimmed_prompt.split()
-        tokens = tokens[:-1]
-        trimmed_prompt = ' '.join(tokens)
-        token_count = count_tokens(trimmed_prompt)
-
-    return trimmed_prompt
+    return trim_tokens(prompt, max_tokens)
 
 
 def extract_json_content(content):
@@ -54,26 +45,14 @@ def extract_json_content(content):
         return None
 
 
-def get_content(diff):
+def get_content(diff: Iterable[Hunk]) -> str:
     """
     Collecting content from Github PR diff.
     Returns the parsed raw text
     """
-    content = ''
-
-    for file in diff:
-        for segments in file["body"]:
-            for line in segments["body"].splitlines():
-                # only count line additions
-                if line.startswith("+"):
-                    # sanitize line
-                    line = line[1:]  # rm addition indicator
-                    line = line.strip()  # rm leading/trailing whitespace
-
-                    # filling the content for further check
-                    content += line + '\n'
 
-    return content
+    # only added lines, stripped of leading/trailing whitespace
+    return ''.join(line.text.strip() + '\n' for hunk in diff for line in hunk.added)
 
 
 def api_call(PROMPT, headers, endpoint):
@@ -174,8 +153,8 @@ def main():
 
     github = Github(args.github_token)
     pr = get_pull_request(github, args.pull_url)
-    _diff = get_diff_by_url(pr)
-    diff = parse_diff(_diff)
+    _diff = get_diff(pr, args.diff_source)
+    diff = parse_diff(_diff, paths=CONTENT_GLOB)
     content = get_content(diff)
 
     whole_prompt = PROMPT % content
@@ -11,9 +11,9 @@ import json
 from github import Github
 
 # Local imports
-from tools.git import get_pull_request, get_diff_by_url, parse_diff
+from tools.git import get_pull_request, get_diff, parse_diff, DIFF_SOURCES, CONTENT_GLOB
 from tools.utils import logging_decorator
-from tools.llm_utils import extract_json, remove_plus
+from tools.llm_utils import extract_json, llm_cache
 import tools.claude_retriever
 from tools.claude_retriever.searcher.searchtools.websearch import BraveSearchTool
 
@@ -35,12 +35,16 @@ def parse_cli_args():
     parser.add_argument(
         "--search-api-key", dest="SEARCH_API_KEY", help="API key for the search engine", required=True
     )
+    parser.add_argument(
+        "--diff-source", dest="diff_source", help="Where to get the PR diff from", choices=DIFF_SOURCES, default="url"
+    )
     return parser.parse_args()
 
 
-def api_call(query, client, model):
+def api_call(query, client, model, workers=1):
     """
     Make an API call and return the response.
+    With more than one worker the statements are verified concurrently.
     """
     try:
         return client.completion_with_retrieval(
@@ -48,7 +52,9 @@ def api_call(query, client, model):
             model=model,
             n_search_results_to_use=1,
             max_searches_to_try=5,
-            max_tokens_to_sample=4000
+            max_tokens_to_sample=4000,
+            parallel=workers > 1,
+            max_workers=workers
         )
     except Exception as e:
         print(f"Error in API call: {e}")
@@ -76,23 +82,29 @@ def main():
         config = json.load(config_file)
 
     search_tool = BraveSearchTool(brave_api_key=args.SEARCH_API_KEY, summarize_with_claude=True,
-                                  anthropic_api_key=args.API_key)
+                                  anthropic_api_key=args.API_key, cache_ttl=config['SEARCH_cache_ttl'])
     model = config['ANTHROPIC_SEARCH_MODEL']
     client = tools.claude_retriever.ClientWithRetrieval(api_key=args.API_key, search_tool=search_tool)
 
     github = Github(args.github_token)
     pr = get_pull_request(github, args.pull_url)
-    _diff = get_diff_by_url(pr)
-    diff = parse_diff(_diff)
+    _diff = get_diff(pr, args.diff_source)
+    hunk = next(parse_diff(_diff, paths=CONTENT_GLOB), None)
+    if hunk is None:
+        print(f"No {CONTENT_GLOB} file in the diff - exit")
+        return
 
     print('-' * 50)
-    print(diff)
+    print(hunk)
     print('-' * 50)
 
-    text = remove_plus(diff[0]['header'] + diff[0]['body'][0]['body'])
-    answer = api_call(text, client, model)
+    # the file name is part of the text, the prompt checks the naming convention
+    text = hunk.path + '\n' + '\n'.join(line.text for line in hunk.added)
+    answer = api_call(text, client, model, config['SEARCH_workers'])
     print('-' * 50)
     print('This is an answer', answer)
     print('-' * 50)
 
-    create_comment_on_pr(pr, answer)
\ No newline at end of file
+    create_comment_on_pr(pr, answer)
+    print("llm_cache", llm_cache.stats())
+    print("search", search_tool.api.stats())
\ No newline at end of file
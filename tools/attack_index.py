@@ -0,0 +1,133 @@
+"""
+Local index of the attack articles published on the wiki.
+
+The index is built from the markdown files in `content/attacks/posts` and stored as JSON in the cache directory.
+Only posts whose size or modification time changed since the last run are parsed again.
+"""
+
+import os
+import re
+import json
+import glob
+import yaml
+
+from tools.cache import CACHE_DIR
+
+
+POSTS_DIR = "content/attacks/posts"
+INDEX_FILE = os.path.join(CACHE_DIR, "attack_index.json")
+INDEX_VERSION = 1
+
+
+def as_list(value) -> list[str]:
+    """
+    Front matter taxonomies can be either a single string or a list.
+    """
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [str(x).strip() for x in value if x is not None]
+    return [str(value).strip()]
+
+
+def split_front_matter(text: str) -> tuple[dict, str]:
+    """
+    Splits a markdown document into its YAML front matter and body.
+    """
+    match = re.match(r"^---\s*\n(.*?)\n---\s*\n?(.*)$", text, re.DOTALL)
+    if not match:
+        return {}, text
+    try:
+        front_matter = yaml.safe_load(match.group(1)) or {}
+    except yaml.YAMLError:
+        front_matter = {}
+    return front_matter, match.group(2)
+
+
+def split_sections(body: str) -> dict[str, str]:
+    """
+    Splits a markdown body into its `## ` sections.
+    """
+    sections = {}
+    for match in re.finditer(r"^## (.+?)\n(.*?)(?=^## |\Z)", body, re.DOTALL | re.MULTILINE):
+        sections[match.group(1).strip()] = match.group(2).strip()
+    return sections
+
+
+def parse_post(path: str) -> dict:
+    """
+    Parses an attack article into an index entry.
+    """
+    # some posts start with a byte order mark
+    with open(path, "r", encoding="utf-8-sig") as file:
+        text = file.read()
+    front_matter, body = split_front_matter(text)
+    summary = re.search(r"^## Summary.*", body, re.DOTALL | re.MULTILINE)
+    slug = os.path.splitext(os.path.basename(path))[0]
+    stat = os.stat(path)
+    return {
+        "path": path,
+        "mtime": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "url": f"/attacks/posts/{slug.lower()}/",
+        "title": str(front_matter.get("title", "")),
+        "date": str(front_matter.get("date", "")),
+        "loss": front_matter.get("loss"),
+        "target_entities": as_list(front_matter.get("target-entities")),
+        "entity_types": as_list(front_matter.get("entity-types")),
+        "attack_types": as_list(front_matter.get("attack-types")),
+        "sections": split_sections(body),
+        "text": summary.group(0) if summary else body.strip(),
+    }
+
+
+def load_index(posts_dir: str = POSTS_DIR, index_file: str = INDEX_FILE) -> dict[str, dict]:
+    """
+    Loads the index and brings it up to date with the posts directory.
+    Returns a dictionary of entries keyed by file path.
+    """
+    entries = {}
+    try:
+        with open(index_file, "r", encoding="utf-8") as file:
+            stored = json.load(file)
+        if stored.get("version") == INDEX_VERSION and stored.get("posts_dir") == posts_dir:
+            entries = stored["entries"]
+    except (OSError, ValueError):
+        pass
+
+    changed = False
+    paths = set()
+    for path in glob.glob(os.path.join(posts_dir, "*.md")):
+        if os.path.basename(path).startswith("_"):
+            continue
+        paths.add(path)
+        stat = os.stat(path)
+        entry = entries.get(path)
+        if entry and entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+            continue
+        entries[path] = parse_post(path)
+        changed = True
+
+    for path in set(entries) - paths:
+        del entries[path]
+        changed = True
+
+    if changed:
+        os.makedirs(os.path.dirname(index_file) or ".", exist_ok=True)
+        tmp_file = f"{index_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as file:
+            json.dump({"version": INDEX_VERSION, "posts_dir": posts_dir, "entries": entries}, file)
+        os.replace(tmp_file, index_file)
+
+    return entries
+
+
+def find_by_target(index: dict[str, dict], target: str) -> list[dict]:
+    """
+    Returns entries that list the target entity, compared case-insensitively.
+    """
+    target = target.strip().lower()
+    return [
+        entry for entry in index.values()
+        if target in (x.lower() for x in entry["target_entities"])
+    ]
@@ -0,0 +1,134 @@
+"""
+Benford's law and volume concentration statistics of hourly trade distributions.
+
+All functions take 2-D arrays with one row per hour and compute every hour in one vectorized pass,
+so years of hourly data take well under a second. Inputs are the raw distributions returned by the API:
+first digit counts (`first_digit_distribution`) and volume buckets (`volume_distribution`).
+"""
+
+import numpy as np
+
+try:
+    from scipy import stats
+except ImportError:  # scipy is optional, p-values are left out without it
+    stats = None
+
+
+DIGITS = np.arange(1, 10)
+BENFORD = np.log10(1 + 1 / DIGITS)
+# field names of first digit counts, the newer API calls it `firstdigitdist`
+DIGIT_FIELDS = ("first_digit_distribution", "firstdigitdist")
+
+# chi-square critical values for 8 degrees of freedom
+CHI2_CRITICAL = {0.10: 13.362, 0.05: 15.507, 0.01: 20.090}
+# Kolmogorov-Smirnov critical values are c(alpha) / sqrt(n)
+KS_COEFFICIENT = {0.10: 1.22, 0.05: 1.36, 0.01: 1.63}
+# Nigrini's conformity ranges of the first digit mean absolute deviation
+MAD_THRESHOLDS = ((0.006, "close"), (0.012, "acceptable"), (0.015, "marginal"))
+
+
+def digit_counts(distribution: np.ndarray) -> np.ndarray:
+    """
+    Returns the counts of digits 1-9, dropping the leading zero column of 10-element distributions.
+    """
+    distribution = np.nan_to_num(np.atleast_2d(np.asarray(distribution, dtype=np.float64)))
+    return distribution[:, -9:]
+
+
+def ks_critical_value(n, alpha: float = 0.05):
+    """
+    Kolmogorov-Smirnov critical value for samples of size `n`.
+    """
+    with np.errstate(divide="ignore"):
+        return KS_COEFFICIENT[alpha] / np.sqrt(n)
+
+
+def mad_conformity(mad: np.ndarray) -> np.ndarray:
+    """
+    Classifies mean absolute deviations as close, acceptable, marginal or nonconformity.
+    """
+    labels = np.full(np.shape(mad), "nonconformity", dtype=object)
+    for threshold, label in reversed(MAD_THRESHOLDS):
+        labels[np.asarray(mad) <= threshold] = label
+    return labels
+
+
+def benford_tests(distribution: np.ndarray, alpha: float = 0.05) -> dict[str, np.ndarray]:
+    """
+    Compares each row of first digit counts with Benford's law.
+
+    Returns arrays with one value per row: sample size `n`, `chi2` statistic and its `chi2_critical` value,
+    `chi2_pvalue` (only with scipy), mean absolute deviation `mad`, Kolmogorov-Smirnov statistic `ks`
+    and `ks_critical`, and `rejected` when either test rejects conformity at `alpha`.
+    """
+    counts = digit_counts(distribution)
+    n = counts.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        observed = counts / n[:, None]
+        expected = n[:, None] * BENFORD
+        chi2 = ((counts - expected) ** 2 / expected).sum(axis=1)
+        mad = np.abs(observed - BENFORD).mean(axis=1)
+        ks = np.abs(np.cumsum(observed, axis=1) - np.cumsum(BENFORD)).max(axis=1)
+    empty = n == 0
+    chi2[empty] = mad[empty] = ks[empty] = np.nan
+
+    result = {
+        "n": n,
+        "chi2": chi2,
+        "chi2_critical": np.full(len(n), CHI2_CRITICAL[alpha]),
+        "mad": mad,
+        "ks": ks,
+        "ks_critical": ks_critical_value(n, alpha),
+    }
+    if stats is not None:
+        result["chi2_pvalue"] = stats.chi2.sf(chi2, df=8)
+    result["rejected"] = (chi2 > result["chi2_critical"]) | (ks > result["ks_critical"])
+    return result
+
+
+def volume_concentration(volumes: np.ndarray, counts: np.ndarray, tail: float = 0.9) -> dict[str, np.ndarray]:
+    """
+    Concentration of trades over volume buckets, one value per row.
+
+    :param volumes: Bucket volumes, NaN for missing buckets.
+    :param counts: Number of trades in each bucket.
+    :param tail: Buckets above this quantile of the bucket volumes are the large trades.
+    Returns `hhi` (Herfindahl index of the trade count shares), `top_bucket_share` (largest count share),
+    `gini` of the counts across buckets and `tail_volume_share` (share of the traded volume in the large buckets).
+    """
+    volumes = np.atleast_2d(np.asarray(volumes, dtype=np.float64))
+    counts = np.nan_to_num(np.atleast_2d(np.asarray(counts, dtype=np.float64)))
+    present = ~np.isnan(volumes)
+    counts = np.where(present, counts, 0)
+    total = counts.sum(axis=1)
+    buckets = present.sum(axis=1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        shares = counts / total[:, None]
+        hhi = (shares ** 2).sum(axis=1)
+        top_bucket_share = shares.max(axis=1)
+
+        # Gini over buckets: missing buckets are sorted first with zero counts and don't change the sum
+        ordered = np.sort(counts, axis=1)
+        rank = np.arange(1, counts.shape[1] + 1) - (counts.shape[1] - buckets)[:, None]
+        gini = (2 * (rank * ordered).sum(axis=1) / (buckets * total)) - (buckets + 1) / buckets
+
+        traded = np.where(present, volumes * counts, 0)
+        # row-wise linear quantile of the present buckets, NaN sort last (np.nanquantile loops over rows)
+        position = tail * np.maximum(buckets - 1, 0)
+        low = np.floor(position).astype(int)
+        high = np.ceil(position).astype(int)
+        ordered_volumes = np.sort(volumes, axis=1)
+        rows = np.arange(len(volumes))
+        cutoff = ordered_volumes[rows, low] + (ordered_volumes[rows, high] - ordered_volumes[rows, low]) * (position - low)
+        tail_volume_share = np.where(present & (volumes > cutoff[:, None]), traded, 0).sum(axis=1) / traded.sum(axis=1)
+
+    empty = total == 0
+    for array in (hhi, top_bucket_share, gini, tail_volume_share):
+        array[empty] = np.nan
+    return {
+        "hhi": hhi,
+        "top_bucket_share": top_bucket_share,
+        "gini": gini,
+        "tail_volume_share": tail_volume_share,
+    }
@@ -0,0 +1,142 @@
+"""
+Persistent on-disk cache shared by the review bots.
+
+Entries are stored as JSON files under `CACHE_DIR/<namespace>/`, sharded by the first two characters of the key.
+Old entries are evicted by age and, when the namespace grows beyond its size limit, least recently used first.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import Any, Optional
+
+
+CACHE_DIR = os.environ.get("DNI_CACHE_DIR", ".cache")
+
+
+def hash_key(*parts) -> str:
+    """
+    Builds a content-addressed key from any JSON-serializable values.
+    """
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    def __init__(self, namespace: str, max_age: Optional[float] = None, max_size: Optional[int] = None,
+                 directory: Optional[str] = None):
+        """
+        :param namespace: Subdirectory of the cache root used by this cache.
+        :param max_age: Entries older than this many seconds are treated as missing and evicted.
+        :param max_size: Upper bound for the namespace size in bytes.
+        :param directory: Cache root, defaults to `CACHE_DIR`.
+        """
+        self.directory = os.path.join(directory or CACHE_DIR, namespace)
+        self.namespace = namespace
+        self.max_age = max_age
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._evicted = False
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """
+        Returns the cached value for the key or `default` if it is missing or expired.
+        """
+        if not self._evicted:
+            self.evict()
+
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            self._count(False)
+            return default
+
+        if self.max_age is not None and time.time() - entry["created"] > self.max_age:
+            self._remove(path)
+            self._count(False)
+            return default
+
+        # touch the entry so size-based eviction drops the least recently used first
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self._count(True)
+        return entry["value"]
+
+    def set(self, key: str, value: Any) -> None:
+        """
+        Stores a JSON-serializable value under the key.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump({"created": time.time(), "value": value}, file, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _remove(self, path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self) -> None:
+        """
+        Removes expired entries, then the least recently used ones until the namespace fits in `max_size`.
+        """
+        self._evicted = True
+        if not os.path.isdir(self.directory):
+            return
+
+        now = time.time()
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if self.max_age is not None and now - stat.st_mtime > self.max_age and name.endswith(".json"):
+                    # mtime is refreshed on hits, the creation time inside the entry is checked on read
+                    self._remove(path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        if self.max_size is None:
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+
+    def stats(self) -> dict:
+        """
+        Returns hit/miss counters of the current process.
+        """
+        total = self.hits + self.misses
+        return {
+            "namespace": self.namespace,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
@@ -1,11 +1,15 @@
 from typing import Optional, Tuple
 from anthropic import Anthropic, HUMAN_PROMPT, AI_PROMPT
-from .searcher.types import SearchTool, SearchResult, Tool
+from .searcher.types import SearchTool, SearchResult, Tool, run_sync
 import logging
 import re
+import asyncio
 from utils import format_results_full
 import json
+from types import SimpleNamespace
 from datetime import datetime
+from tools.llm_utils import llm_cache, completion_cache_key
+from tools.rate_limit import get_limiter, estimate_tokens
 
 
 logger = logging.getLogger(__name__)
@@ -35,6 +39,21 @@ If you need to search again, put the new query in <search_query></search_query>.
 Statements to be verified: 
 """
 
+STATEMENT_RETRIEVAL_PROMPT = """
+Your timeline extends up to the current one — {current_time}.
+You are tasked with verifying the accuracy of a single factual statement using a search engine. Below is the search engine's description: <tool_description>{description}</tool_description>.
+For the statement within <statement></statement> tags formulate a query to check its accuracy. You can make a call to the search engine tool by inserting a query within <search_query> tags like so: <search_query>query</search_query>. You'll then get results back within <search_result></search_result> tags.
+Based on these results, determine the accuracy of the statement and categorize it as 'True', 'False', or 'Unverified'.
+Put your verdict in <verdict></verdict> tags.
+Include the Web Page URL in <source></source> tags. If there is no URL at all, put 'None' in the <source></source> tags.
+If the statement is false, include an explanation in <explanation></explanation> tags.
+Focus particularly on verifying numbers, dates, monetary values, and names of people or organizations.
+Determine the accuracy of the statement using only information that is contained in the search_result.
+If you need to search again, put the new query in <search_query></search_query>.
+
+Statement to be verified: 
+"""
+
 ANSWER_PROMPT = """
 
 <fact_checking_results>%s</fact_checking_results>
@@ -127,6 +146,8 @@ class ClientWithRetrieval(Anthropic):
             verbose (bool): Whether to print verbose logging
             *args, **kwargs: Passed to superclass init
         """
+        # retries are done by the shared rate limiter
+        kwargs.setdefault("max_retries", 0)
         super().__init__(*args, **kwargs)
         self.search_tool = search_tool
         self.verbose = verbose
@@ -134,7 +155,7 @@ class ClientWithRetrieval(Anthropic):
 
     def extract_statements(self, text: str, model: str, temperature: float = 0.0, max_tokens_to_sample: int = 1000):
         prompt = f"{EXTRACTING_PROMPT} {HUMAN_PROMPT} <text>{text}</text>{AI_PROMPT}"
-        completion = self.completions.create(prompt=prompt, model=model, temperature=temperature, max_tokens_to_sample=max_tokens_to_sample).completion
+        completion = self._create_completion(prompt=prompt, model=model, temperature=temperature, max_tokens_to_sample=max_tokens_to_sample).completion
         return completion
     
 
@@ -159,12 +180,13 @@ class ClientWithRetrieval(Anthropic):
         description = self.search_tool.tool_description
         statements = self.extract_statements(query, model=model, max_tokens_to_sample=max_tokens_to_sample, temperature=temperature)
         num_of_statements = int(self.extract_between_tags("number_of_statements", statements, strip=True))
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # only the day, so the prompt and its completion cache key stay the same between runs of a day
+        current_time = datetime.now().strftime("%Y-%m-%d")
         prompt = f"{RETRIEVAL_PROMPT.format(current_time=current_time, description=description)}{HUMAN_PROMPT} {statements} {AI_PROMPT}"
         token_budget = max_tokens_to_sample
         completions = ""
         for tries in range(num_of_statements):
-            partial_completion = self.completions.create(prompt = prompt,
+            partial_completion = self._create_completion(prompt = prompt,
                                                      stop_sequences=stop_sequences + ['</search_query>'],
                                                      model=model,
                                                      max_tokens_to_sample = token_budget,
@@ -184,6 +206,99 @@ class ClientWithRetrieval(Anthropic):
         return completions
 
 
+    async def averify_statement(self,
+                                statement: str,
+                                model: str,
+                                n_search_results_to_use: int = 3,
+                                stop_sequences: list[str] = [HUMAN_PROMPT],
+                                max_tokens_to_sample: int = 1000,
+                                max_searches_to_try: int = 5,
+                                temperature: float = 0.0) -> str:
+        """
+        Verifies a single statement in its own short conversation with the search tool.
+
+        Returns the statement with its <verdict>, <source> and <explanation> tags
+        """
+        description = self.search_tool.tool_description
+        current_time = datetime.now().strftime("%Y-%m-%d")
+        prompt = f"{STATEMENT_RETRIEVAL_PROMPT.format(current_time=current_time, description=description)}{HUMAN_PROMPT} <statement>{statement}</statement> {AI_PROMPT}"
+        completions = ""
+        for tries in range(max_searches_to_try + 1):
+            # the Anthropic client is blocking, run it in a thread so other statements keep going
+            partial_completion = await asyncio.to_thread(self._create_completion,
+                                                         prompt=prompt,
+                                                         stop_sequences=stop_sequences + ['</search_query>'],
+                                                         model=model,
+                                                         max_tokens_to_sample=max_tokens_to_sample,
+                                                         temperature=temperature)
+            completion, stop_reason, stop_seq = partial_completion.completion, partial_completion.stop_reason, partial_completion.stop
+            completions += completion
+            prompt += completion
+            if stop_reason == 'stop_sequence' and stop_seq == '</search_query>' and tries < max_searches_to_try:
+                logger.info(f'Attempting search number {tries} for statement: {statement}')
+                formatted_search_results = await self._asearch_query_stop(completion, n_search_results_to_use)
+                prompt += '</search_query>' + formatted_search_results
+            else:
+                break
+
+        # search results are not part of `completions`, so the tags can only come from Claude
+        result = f"<statement>{statement}</statement>\n" \
+                 f"<verdict>{self.extract_between_tags('verdict', completions) or 'Unverified'}</verdict>\n" \
+                 f"<source>{self.extract_between_tags('source', completions) or 'None'}</source>"
+        explanation = self.extract_between_tags('explanation', completions)
+        if explanation:
+            result += f"\n<explanation>{explanation}</explanation>"
+        return result
+
+
+    async def aretrieve_parallel(self,
+                                 query: str,
+                                 model: str,
+                                 n_search_results_to_use: int = 3,
+                                 stop_sequences: list[str] = [HUMAN_PROMPT],
+                                 max_tokens_to_sample: int = 1000,
+                                 max_searches_to_try: int = 5,
+                                 temperature: float = 0.0,
+                                 max_workers: int = 4) -> str:
+        """
+        Same as retrieve(), but every extracted statement is verified by an independent concurrent task.
+        Each task keeps a small prompt with one statement and its own search results,
+        instead of one conversation that grows with every search.
+        At most `max_workers` statements are verified at a time, all searches and page scrapes share the running loop.
+
+        Returns string with fact-checking results
+        """
+        assert self.search_tool is not None, "SearchTool must be provided to use .retrieve_parallel()"
+
+        extracted = await asyncio.to_thread(self.extract_statements, query, model=model,
+                                            max_tokens_to_sample=max_tokens_to_sample, temperature=temperature)
+        statements = [s.strip() for s in re.findall(r"<statement>(.+?)</statement>", extracted, re.DOTALL)]
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def verify(statement: str) -> str:
+            async with semaphore:
+                try:
+                    return await self.averify_statement(statement, model=model,
+                                                        n_search_results_to_use=n_search_results_to_use,
+                                                        stop_sequences=stop_sequences,
+                                                        max_tokens_to_sample=max_tokens_to_sample,
+                                                        max_searches_to_try=max_searches_to_try,
+                                                        temperature=temperature)
+                except Exception as e:
+                    logger.warning(f"Failed to verify statement '{statement}': {e}")
+                    return f"<statement>{statement}</statement>\n<verdict>Unverified</verdict>\n<source>None</source>"
+
+        results = await asyncio.gather(*(verify(statement) for statement in statements))
+        return "\n\n".join(results)
+
+
+    def retrieve_parallel(self, query: str, model: str, **kwargs) -> str:
+        """
+        Sync wrapper around aretrieve_parallel().
+        """
+        return run_sync(self.aretrieve_parallel(query, model, **kwargs))
+
+
     def answer_with_results(self, search_results: str, query: str, model: str, temperature: float):
         """Generates an RAG response based on search results and a query. If format_results is True,
            formats the raw search results first. Set format_results to True if you are using this method standalone without retrieve().
@@ -197,7 +312,7 @@ class ClientWithRetrieval(Anthropic):
         except Exception as e:
             print(str(e))        
         try:
-            answer = self.completions.create(
+            answer = self._create_completion(
                 prompt=prompt, 
                 model=model, 
                 temperature=temperature, 
@@ -216,17 +331,27 @@ class ClientWithRetrieval(Anthropic):
                                         stop_sequences: list[str] = [HUMAN_PROMPT],
                                         max_tokens_to_sample: int = 1000,
                                         max_searches_to_try: int = 5,
-                                        temperature: float = 0.0) -> str:
+                                        temperature: float = 0.0,
+                                        parallel: bool = False,
+                                        max_workers: int = 4) -> str:
         """
         Gets a final completion from retrieval results        
         
-        Calls retrieve() to get search results.
+        Calls retrieve() or, if `parallel` is set, retrieve_parallel() to get search results.
         Calls answer_with_results() with search results and query.
         
         Returns:
             str: Claude's answer to the query
         """
-        search_results = self.retrieve(query, model=model,
+        if parallel:
+            search_results = self.retrieve_parallel(query, model=model,
+                                                    n_search_results_to_use=n_search_results_to_use, stop_sequences=stop_sequences,
+                                                    max_tokens_to_sample=max_tokens_to_sample,
+                                                    max_searches_to_try=max_searches_to_try,
+                                                    temperature=temperature,
+                                                    max_workers=max_workers)
+        else:
+            search_results = self.retrieve(query, model=model,
                                                  n_search_results_to_use=n_search_results_to_use, stop_sequences=stop_sequences,
                                                  max_tokens_to_sample=max_tokens_to_sample,
                                                  max_searches_to_try=max_searches_to_try,
@@ -237,7 +362,30 @@ class ClientWithRetrieval(Anthropic):
     
 
     # Helper methods
-    def _search_query_stop(self, partial_completion: str, n_search_results_to_use: int) -> Tuple[list[SearchResult], str]:
+    def _create_completion(self, prompt: str, model: str, temperature: float, max_tokens_to_sample: int,
+                           stop_sequences: Optional[list[str]] = None):
+        """
+        Wrapper around completions.create() that serves repeated requests from the shared LLM cache.
+
+        Returns:
+            object with `completion`, `stop_reason` and `stop` attributes
+        """
+        messages = {"prompt": prompt, "stop_sequences": stop_sequences}
+        cache_key = completion_cache_key(model, messages, temperature, max_tokens_to_sample)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return SimpleNamespace(**cached)
+
+        kwargs = {"stop_sequences": stop_sequences} if stop_sequences is not None else {}
+        response = get_limiter("anthropic").call(self.completions.create,
+                                                 tokens=estimate_tokens(prompt) + max_tokens_to_sample,
+                                                 prompt=prompt, model=model, temperature=temperature,
+                                                 max_tokens_to_sample=max_tokens_to_sample, **kwargs)
+        result = {"completion": response.completion, "stop_reason": response.stop_reason, "stop": getattr(response, "stop", None)}
+        llm_cache.set(cache_key, result)
+        return SimpleNamespace(**result)
+
+    async def _asearch_query_stop(self, partial_completion: str, n_search_results_to_use: int) -> Tuple[list[SearchResult], str]:
         """
         Helper to handle search query stop case.
         
@@ -258,13 +406,20 @@ class ClientWithRetrieval(Anthropic):
         if self.verbose:
             logger.info('\n'+'-'*20 + f'\nPausing stream because Claude has issued a query in <search_query> tags: <search_query>{search_query}</search_query>\n' + '-'*20)
         logger.info(f'Running search query against SearchTool: {search_query}')
-        search_results = self.search_tool.raw_search(search_query, n_search_results_to_use)
+        search_results = await self.search_tool.araw_search(search_query, n_search_results_to_use)
         extracted_search_results = self.search_tool.process_raw_search_results(search_results)
         formatted_search_results = format_results_full(extracted_search_results)
 
         if self.verbose:
             logger.info('\n' + '-'*20 + f'\nThe SearchTool has returned the following search results:\n\n{formatted_search_results}\n\n' + '-'*20 + '\n')
         return formatted_search_results
+
+
+    def _search_query_stop(self, partial_completion: str, n_search_results_to_use: int) -> str:
+        """
+        Sync wrapper around _asearch_query_stop().
+        """
+        return run_sync(self._asearch_query_stop(partial_completion, n_search_results_to_use))
     
 
     def extract_between_tags(self, tag, string, strip=True):
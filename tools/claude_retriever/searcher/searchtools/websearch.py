@@ -2,7 +2,11 @@ import os
 from typing import Optional
 from tools.claude_retriever.searcher.types import SearchResult, SearchTool
 from tools.claude_retriever.utils import scrape_url
+from tools.cache import DiskCache, hash_key
 from dataclasses import dataclass
+from concurrent.futures import Future
+import threading
+import time
 import requests
 import asyncio
 from tenacity import retry, wait_exponential, stop_after_attempt
@@ -18,12 +22,77 @@ class WebSearchResult(SearchResult):
 
 BRAVE_DESCRIPTION = """Brave Search Engine Tool: The search engine will search using the Brave search engine for web pages with keywords similar to your query. It returns for each page its title, a summary and potentially the full page content. Use this tool if you want to get up-to-date and comprehensive information on a topic."""
 
+# Search results for the same incident rarely change within a day
+BRAVE_CACHE_TTL = 24 * 3600
+
 class BraveAPI:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, cache_ttl: Optional[float] = BRAVE_CACHE_TTL):
+        """
+        :param api_key: The Brave API key to use for searching.
+        :param cache_ttl: Seconds a cached response stays valid, 0 disables the cache.
+        """
         self.api_key = api_key
+        self.cache = DiskCache("brave", max_age=cache_ttl, max_size=50 * 1024 * 1024) if cache_ttl else None
+        self._in_flight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.latencies: dict[str, list[float]] = {}
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        return " ".join(query.lower().split())
 
-    @retry(wait=wait_exponential(multiplier=1, min=4, max=10), stop=stop_after_attempt(10))
     def search(self, query: str) -> dict:
+        """
+        Returns the Brave response for a query, from the cache when possible.
+        Identical queries running at the same time share a single request.
+        """
+        started = time.monotonic()
+        normalized = self.normalize_query(query)
+        key = hash_key(normalized)
+        try:
+            if self.cache is not None:
+                cached = self.cache.get(key)
+                if cached is not None:
+                    return cached
+
+            with self._lock:
+                future = self._in_flight.get(normalized)
+                owner = future is None
+                if owner:
+                    future = self._in_flight[normalized] = Future()
+            if not owner:
+                logger.info(f"Waiting for the in-flight search: {normalized}")
+                return future.result()
+
+            try:
+                result = self._request(query)
+                if result and self.cache is not None:
+                    self.cache.set(key, result)
+                future.set_result(result)
+                return result
+            except Exception as e:
+                future.set_exception(e)
+                raise
+            finally:
+                with self._lock:
+                    del self._in_flight[normalized]
+        finally:
+            with self._lock:
+                self.latencies.setdefault(normalized, []).append(time.monotonic() - started)
+
+    def stats(self) -> dict:
+        """
+        Returns the cache hit rate and per-query latencies of the current process.
+        """
+        with self._lock:
+            latencies = {query: [round(x, 3) for x in values] for query, values in self.latencies.items()}
+        return {
+            "cache": self.cache.stats() if self.cache is not None else None,
+            "latencies": latencies,
+        }
+
+    @retry(wait=wait_exponential(multiplier=1, min=4, max=10), stop=stop_after_attempt(10))
+    def _request(self, query: str) -> dict:
         headers = {"Accept": "application/json", "X-Subscription-Token": self.api_key}
         resp = requests.get(
             "https://api.search.brave.com/res/v1/web/search",
@@ -43,15 +112,17 @@ class BraveSearchTool(SearchTool):
     def __init__(self, brave_api_key: str,
                  tool_description: str = BRAVE_DESCRIPTION,
                  summarize_with_claude: bool = False,
-                 anthropic_api_key: Optional[str] = None):
+                 anthropic_api_key: Optional[str] = None,
+                 cache_ttl: Optional[float] = BRAVE_CACHE_TTL):
         """
         :param brave_api_key: The Brave API key to use for searching.
         :param tool_description: The description of the tool.
         :param summarize_with_claude: Whether to summarize the scraped web pages with Claude.
         :param anthropic_api_key: The anthropic API key to use for summarizing with Claude.
+        :param cache_ttl: Seconds a cached search response stays valid, 0 disables the cache.
         """
 
-        self.api = BraveAPI(brave_api_key)
+        self.api = BraveAPI(brave_api_key, cache_ttl=cache_ttl)
         self.tool_description = tool_description
         self.summarize_with_claude = summarize_with_claude
         if summarize_with_claude and anthropic_api_key is None:
@@ -132,7 +203,7 @@ Web Page URL: {url}"""
         )
 
 
-    def raw_search(self, query: str, n_search_results_to_use: int) -> list[WebSearchResult]:
+    async def araw_search(self, query: str, n_search_results_to_use: int) -> list[WebSearchResult]:
         """
         Run a search using the BraveAPI and return search results. Here are some details on the Brave API:
 
@@ -152,7 +223,8 @@ Web Page URL: {url}"""
         
         # Run the search
 
-        search_response = self.api.search(query)
+        # the Brave client is blocking, keep the loop free for the page scrapes of other queries
+        search_response = await asyncio.to_thread(self.api.search, query)
 
         # Order everything properly
 
@@ -167,7 +239,6 @@ Web Page URL: {url}"""
         # Get the search results
 
         search_results: list[WebSearchResult] = []
-        async_web_parser_loop = asyncio.get_event_loop()
         web_parsing_tasks = [] # We'll queue up the web parsing tasks here, since they're costly
 
         for item in correct_ordering:
@@ -182,7 +253,7 @@ Web Page URL: {url}"""
                 )
                 search_results.append(placeholder_search_result)
                 ## Queue up the web parsing task
-                task = async_web_parser_loop.create_task(self.parse_web(web_item, query))
+                task = asyncio.create_task(self.parse_web(web_item, query))
                 web_parsing_tasks.append(task)
             elif item_type == "news":
                 parsed_news = self.parse_news(news_items.pop(0))
@@ -195,7 +266,7 @@ Web Page URL: {url}"""
                 break
 
         ## Replace the placeholder search results with the parsed web results
-        web_results = async_web_parser_loop.run_until_complete(asyncio.gather(*web_parsing_tasks))
+        web_results = await asyncio.gather(*web_parsing_tasks)
         web_results_urls = [web_result.url for web_result in web_results]
         for i, search_result in enumerate(search_results):
             url = search_result.url
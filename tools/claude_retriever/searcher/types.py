@@ -1,5 +1,7 @@
 from dataclasses import dataclass
 from abc import ABC, abstractmethod
+import asyncio
+import threading
 
 import sys
 import os
@@ -7,6 +9,26 @@ parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, parent_dir) 
 
 
+_thread_state = threading.local()
+
+def run_sync(coroutine):
+    """
+    Runs a coroutine to completion from synchronous code.
+    Each thread reuses its own event loop, so pooled connections survive between calls.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        coroutine.close()
+        raise RuntimeError("Can't run a sync wrapper inside a running event loop, await the async method instead")
+    loop = getattr(_thread_state, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = _thread_state.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(coroutine)
+
+
 #########################################################
 ## Search Tool: A wrapper around a searcher with instructions and formatting to help Claude use it
 #########################################################
@@ -29,15 +51,28 @@ class SearchTool(Tool):
     def __init__(self, tool_description: str):
         self.tool_description = tool_description
 
-    @abstractmethod
-    def raw_search(self, query: str, n_search_results_to_use: int) -> list[SearchResult]:
+    async def araw_search(self, query: str, n_search_results_to_use: int) -> list[SearchResult]:
         """
         Runs a query using the searcher, then returns the raw search results without formatting.
+        Subclasses should override either this method or raw_search(); a sync raw_search() is run in a thread.
 
         :param query: The query to run.
         :param n_search_results_to_use: The number of results to return.
         """
-        raise NotImplementedError()
+        if type(self).raw_search is SearchTool.raw_search:
+            raise NotImplementedError()
+        return await asyncio.to_thread(self.raw_search, query, n_search_results_to_use)
+
+    def raw_search(self, query: str, n_search_results_to_use: int) -> list[SearchResult]:
+        """
+        Sync wrapper around araw_search().
+
+        :param query: The query to run.
+        :param n_search_results_to_use: The number of results to return.
+        """
+        if type(self).araw_search is SearchTool.araw_search:
+            raise NotImplementedError()
+        return run_sync(self.araw_search(query, n_search_results_to_use))
     
     @abstractmethod
     def process_raw_search_results(
@@ -50,13 +85,19 @@ class SearchTool(Tool):
         """
         raise NotImplementedError()
     
-    def search(self, query: str, n_search_results_to_use: int) -> str:
+    async def asearch(self, query: str, n_search_results_to_use: int) -> str:
         from utils import format_results_full # Avoids circular import
 
-        raw_search_results = self.raw_search(query, n_search_results_to_use)
+        raw_search_results = await self.araw_search(query, n_search_results_to_use)
         processed_search_results = self.process_raw_search_results(raw_search_results)
         displayable_search_results = format_results_full(processed_search_results)
-        return displayable_search_results 
+        return displayable_search_results
+
+    def search(self, query: str, n_search_results_to_use: int) -> str:
+        """
+        Sync wrapper around asearch().
+        """
+        return run_sync(self.asearch(query, n_search_results_to_use)) 
 
 
 
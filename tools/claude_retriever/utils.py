@@ -1,13 +1,97 @@
 import os
+import re
+import time
+import atexit
+import asyncio
 import aiohttp
-from typing import Optional
+from functools import lru_cache
+from typing import Mapping, Optional
 from bs4 import BeautifulSoup
 import anthropic
 from anthropic import Anthropic, AsyncAnthropic
 import logging
+from tools.cache import DiskCache, hash_key
+from tools.rate_limit import get_limiter, estimate_tokens
 
 logger = logging.getLogger(__name__)
 
+class SessionManager:
+    """
+    Process-wide pool of aiohttp sessions, one per event loop.
+    Connections are kept alive and shared by all scrapes, the connector caps parallel requests globally and per host.
+    """
+
+    def __init__(self, limit: int = 20, limit_per_host: int = 4, timeout: float = 20,
+                 max_response_size: int = 5 * 1024 * 1024):
+        """
+        :param limit: Maximum number of parallel connections.
+        :param limit_per_host: Maximum number of parallel connections to one host.
+        :param timeout: Total timeout of a request in seconds.
+        :param max_response_size: Bodies are truncated after this many bytes.
+        """
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.max_response_size = max_response_size
+        self._sessions: dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+        atexit.register(self.close_all)
+
+    def get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            # sessions of finished loops can't be closed anymore, just forget them
+            for stale in [l for l in self._sessions if l.is_closed()]:
+                del self._sessions[stale]
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host, ttl_dns_cache=300)
+            session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._sessions[loop] = session
+        return session
+
+    async def fetch(self, url: str, headers: Optional[dict] = None) -> tuple[int, Mapping[str, str], Optional[str], bool]:
+        """
+        Makes a GET request and returns the status, the case-insensitive response headers, the body text
+        and whether the body was truncated.
+        The body is only read for 200 responses and is cut at `max_response_size` bytes.
+        """
+        async with self.get_session().get(url, headers=headers) as response:
+            if response.status != 200:
+                return response.status, response.headers, None, False
+            body = bytearray()
+            truncated = False
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                body += chunk
+                if len(body) > self.max_response_size:
+                    logger.warning(f"Response of {url} exceeds {self.max_response_size} bytes, truncating")
+                    del body[self.max_response_size:]
+                    truncated = True
+                    break
+            encoding = response.get_encoding() if response.charset else "utf-8"
+            return response.status, response.headers, body.decode(encoding, errors="replace"), truncated
+
+    async def close(self) -> None:
+        """
+        Closes the session of the running event loop.
+        """
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def close_all(self) -> None:
+        for loop, session in list(self._sessions.items()):
+            if not session.closed and not loop.is_closed() and not loop.is_running():
+                loop.run_until_complete(session.close())
+        self._sessions.clear()
+
+
+sessions = SessionManager()
+
+# Pages are kept with their validators and revalidated with conditional requests, so no age limit is needed
+page_cache = DiskCache("pages", max_size=200 * 1024 * 1024)
+summary_cache = DiskCache("summaries", max_age=7 * 24 * 3600, max_size=50 * 1024 * 1024)
+
+SUMMARY_MODEL = "claude-instant-v1"
+
 # Formatting search results
 def format_results(extracted: list[str]) -> str:
     """
@@ -53,26 +137,98 @@ async def scrape_url(url: str, summarize_with_claude: bool = False,
         content = missing_content_placeholder
     return content
 
+def _max_age(cache_control: str) -> Optional[int]:
+    if "no-store" in cache_control or "no-cache" in cache_control:
+        return None
+    match = re.search(r"max-age=(\d+)", cache_control)
+    return int(match.group(1)) if match else None
+
+
 async def get_url_content(url: str) -> Optional[str]:
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status == 200:
-                html = await response.text()
-                soup = BeautifulSoup(html, 'html.parser')
-                text = soup.get_text(strip=True, separator='\n')
-                return text
+    """
+    Returns the text of a web page.
+    Extracted text is kept in the page cache together with the ETag/Last-Modified headers;
+    fresh pages are served from disk and stale ones are revalidated with a conditional request.
+    """
+    key = hash_key(url)
+    cached = page_cache.get(key)
+    headers = {}
+    if cached:
+        if cached["expires"] and cached["expires"] > time.time():
+            return cached["text"]
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    status, response_headers, html, truncated = await sessions.fetch(url, headers)
+    if status == 304 and cached:
+        logger.info(f"Page not modified, using the cached text of {url}")
+        return cached["text"]
+    if status == 200:
+        soup = BeautifulSoup(html, 'html.parser')
+        text = soup.get_text(strip=True, separator='\n')
+
+        cache_control = response_headers.get("Cache-Control", "")
+        max_age = _max_age(cache_control)
+        etag = response_headers.get("ETag")
+        last_modified = response_headers.get("Last-Modified")
+        # a truncated page is not what the validators describe, it is fetched again next time
+        if not truncated and "no-store" not in cache_control and (etag or last_modified or max_age):
+            page_cache.set(key, {
+                "text": text,
+                "etag": etag,
+                "last_modified": last_modified,
+                "expires": time.time() + max_age if max_age else None,
+            })
+        return text
     return None
 
+@lru_cache(maxsize=None)
+def get_tokenizer():
+    """
+    Returns the Claude tokenizer, loaded once per process. It doesn't depend on the API key.
+    """
+    return Anthropic(api_key="").get_tokenizer()
+
+
+# async clients hold an httpx connection pool tied to the event loop they were first used in
+_async_clients: dict[tuple[asyncio.AbstractEventLoop, str], AsyncAnthropic] = {}
+
+
+def get_async_client(anthropic_api_key: str) -> AsyncAnthropic:
+    """
+    Returns a long-lived AsyncAnthropic client for the running event loop and API key.
+    """
+    key = (asyncio.get_running_loop(), anthropic_api_key)
+    client = _async_clients.get(key)
+    if client is None:
+        for stale in [k for k in _async_clients if k[0].is_closed()]:
+            del _async_clients[stale]
+        # retries are done by the shared rate limiter
+        client = _async_clients[key] = AsyncAnthropic(api_key=anthropic_api_key, max_retries=0)
+    return client
+
+
 async def claude_extract(content: str, query: Optional[str], anthropic_api_key: str, max_tokens_to_read: int = 20_000) -> str:
-    
+    """
+    Summarizes a web page with Claude, focusing on the query if given.
+    Summaries are cached by the page content and query, so a page seen again costs no API call.
+    """
+    cache_key = hash_key(SUMMARY_MODEL, content, query, max_tokens_to_read)
+    cached = summary_cache.get(cache_key)
+    if cached is not None:
+        logger.info("Using a cached Claude extract")
+        return cached
+
     # Get first max_tokens_to_read words tokens of content
 
-    client = Anthropic(api_key=anthropic_api_key)
-    tokenizer = client.get_tokenizer()
-    tokenized_content = tokenizer.encode(content).ids
-    if len(tokenized_content) > max_tokens_to_read:
-        logger.info(f"Truncating content from {len(tokenized_content)} tokens to {max_tokens_to_read} tokens")
-        content = tokenizer.decode(tokenized_content[:max_tokens_to_read]).strip()
+    tokenized_content = get_tokenizer().encode(content).ids
+    num_tokens = len(tokenized_content)
+    if num_tokens > max_tokens_to_read:
+        logger.info(f"Truncating content from {num_tokens} tokens to {max_tokens_to_read} tokens")
+        content = get_tokenizer().decode(tokenized_content[:max_tokens_to_read]).strip()
+        num_tokens = max_tokens_to_read
 
     # Generate prompt
 
@@ -111,14 +267,15 @@ Here is a search query a user made which resulted in this page:
 </instructions>{anthropic.AI_PROMPT} Based on the given content{' and query' if query else ''}, the summary of the page would be:
 <summary>"""
 
-    logger.info(f"Triggering a Claude extract for a {len(tokenizer.encode(content).ids)} token document")
+    logger.info(f"Triggering a Claude extract for a {num_tokens} token document")
 
-    client = AsyncAnthropic(api_key=anthropic_api_key)
-    response = await client.completions.create(
+    response = await get_limiter("anthropic").acall(
+        get_async_client(anthropic_api_key).completions.create,
+        tokens=estimate_tokens(prompt) + 512,
         prompt=prompt,
         max_tokens_to_sample=512,
         temperature=0.0,
-        model="claude-instant-v1",
+        model=SUMMARY_MODEL,
         stop_sequences=["</summary>", anthropic.HUMAN_PROMPT]
     )
 
@@ -127,4 +284,6 @@ Here is a search query a user made which resulted in this page:
     completion = response.completion
     if not completion.endswith("</summary>"):
         completion += "</summary>"
-    return '<summary>'+completion
+    summary = '<summary>'+completion
+    summary_cache.set(cache_key, summary)
+    return summary
@@ -0,0 +1,222 @@
+#!/bin/env python
+
+"""
+Audits the whole wiki for duplicated articles and lists the collected topics that are already covered.
+"""
+
+import argparse
+import glob
+import json
+import math
+import os
+import re
+from collections import Counter
+import numpy as np
+from scipy import sparse
+
+from tools.attack_index import POSTS_DIR, load_index
+from tools.utils import logging_decorator
+
+
+TOPICS_DIR = "challenge/topic-collection"
+BLOCK_SIZE = 1024
+
+
+def parse_cli_args():
+    """
+    Parse CLI arguments.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--posts-dir", dest="posts_dir", help="Directory with attack articles", default=POSTS_DIR
+    )
+    parser.add_argument(
+        "--topics-dir", dest="topics_dir", help="Directory with topic collections", default=TOPICS_DIR
+    )
+    parser.add_argument(
+        "--threshold", dest="threshold", help="Cosine similarity of duplicated articles", type=float, default=0.5
+    )
+    parser.add_argument(
+        "--topic-threshold", dest="topic_threshold", help="Cosine similarity of a covered topic", type=float, default=0.2
+    )
+    parser.add_argument(
+        "--output", dest="output", help="Path of the JSON report", required=False
+    )
+    return parser.parse_args()
+
+
+def load_documents(posts_dir: str, topics_dir: str) -> list[dict]:
+    """
+    Collects attack articles and topic lines as documents.
+    """
+    documents = [
+        {"id": path, "kind": "post", "text": entry["text"]}
+        for path, entry in sorted(load_index(posts_dir).items())
+    ]
+    for path in sorted(glob.glob(os.path.join(topics_dir, "*.txt"))):
+        with open(path, "r", encoding="utf-8") as file:
+            for number, line in enumerate(file, start=1):
+                if line.strip():
+                    documents.append({"id": f"{path}:{number}", "kind": "topic", "text": line.strip()})
+    return documents
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Lowercases the text and splits it into words, dropping links and one-letter tokens.
+    """
+    text = re.sub(r"\S+\.\S+/\S*", " ", text.lower())
+    return [word for word in re.findall(r"[a-z0-9]+", text) if len(word) > 1]
+
+
+def tfidf_matrix(texts: list[str], max_df: float = 0.5) -> sparse.csr_matrix:
+    """
+    Builds an L2-normalized TF-IDF matrix with sublinear term frequencies.
+    Terms that occur in more than `max_df` of the documents are dropped.
+    Returns a scipy CSR matrix
+    """
+    counts = [Counter(tokenize(text)) for text in texts]
+    document_frequency = Counter()
+    for count in counts:
+        document_frequency.update(count.keys())
+
+    n = len(texts)
+    vocabulary = {
+        term: i for i, term in enumerate(
+            term for term, df in sorted(document_frequency.items()) if df <= max(1, max_df * n)
+        )
+    }
+    idf = np.array([
+        math.log((1 + n) / (1 + document_frequency[term])) + 1 for term in vocabulary
+    ], dtype=np.float32)
+
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    indices, data = [], []
+    for row, count in enumerate(counts):
+        terms = [(vocabulary[term], freq) for term, freq in count.items() if term in vocabulary]
+        indices.extend(term for term, _ in terms)
+        data.extend(freq for _, freq in terms)
+        indptr[row + 1] = len(indices)
+    indices = np.array(indices, dtype=np.int64)
+    data = (1 + np.log(np.array(data, dtype=np.float32))) * idf[indices]
+
+    # normalize rows in one pass over the flat arrays
+    rows = np.repeat(np.arange(n), np.diff(indptr))
+    norms = np.sqrt(np.bincount(rows, weights=data * data, minlength=n)).astype(np.float32)
+    norms[norms == 0] = 1
+    data /= norms[rows]
+
+    return sparse.csr_matrix((data, indices, indptr), shape=(n, len(vocabulary)))
+
+
+def similarity_blocks(matrix, other, block_size: int = BLOCK_SIZE):
+    """
+    Yields (row offset, dense block of cosine similarities between the rows of `matrix` and `other`).
+    Memory is bounded by `block_size` x number of rows of `other`.
+    """
+    other_t = other.T
+    for start in range(0, matrix.shape[0], block_size):
+        yield start, (matrix[start:start + block_size] @ other_t).toarray()
+
+
+def find_duplicates(matrix, kinds: np.ndarray, threshold: float) -> list[tuple[int, int, float]]:
+    """
+    Finds all pairs of articles with cosine similarity above the threshold.
+    """
+    posts = np.flatnonzero(kinds == "post")
+    post_matrix = matrix[posts]
+    pairs = []
+    for start, block in similarity_blocks(post_matrix, post_matrix):
+        rows, cols = np.nonzero(block >= threshold)
+        upper = start + rows < cols
+        for row, col in zip(rows[upper], cols[upper]):
+            pairs.append((int(posts[start + row]), int(posts[col]), float(block[row, col])))
+    return pairs
+
+
+def find_covered_topics(matrix, kinds: np.ndarray, threshold: float) -> list[tuple[int, int, float]]:
+    """
+    Finds the most similar article for every topic and keeps the ones above the threshold.
+    """
+    posts = np.flatnonzero(kinds == "post")
+    topics = np.flatnonzero(kinds == "topic")
+    if not len(posts) or not len(topics):
+        return []
+    covered = []
+    for start, block in similarity_blocks(matrix[topics], matrix[posts]):
+        best = block.argmax(axis=1)
+        scores = block[np.arange(len(best)), best]
+        for row in np.flatnonzero(scores >= threshold):
+            covered.append((int(topics[start + row]), int(posts[best[row]]), float(scores[row])))
+    return covered
+
+
+def cluster_pairs(pairs: list[tuple[int, int, float]]) -> list[list[int]]:
+    """
+    Groups duplicated pairs into connected clusters.
+    """
+    parent = {}
+
+    def find(x):
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for i, j, _ in pairs:
+        parent[find(i)] = find(j)
+
+    clusters = {}
+    for x in parent:
+        clusters.setdefault(find(x), []).append(x)
+    return sorted((sorted(c) for c in clusters.values()), key=len, reverse=True)
+
+
+@logging_decorator("Duplication audit")
+def audit(documents: list[dict], threshold: float, topic_threshold: float) -> dict:
+    """
+    Runs the audit over the documents and returns clusters of duplicates and covered topics.
+    """
+    matrix = tfidf_matrix([doc["text"] for doc in documents])
+    kinds = np.array([doc["kind"] for doc in documents])
+    pairs = find_duplicates(matrix, kinds, threshold)
+    clusters = cluster_pairs(pairs)
+    cluster_of = {i: number for number, cluster in enumerate(clusters) for i in cluster}
+    max_similarity = [0.0] * len(clusters)
+    for i, _, score in pairs:
+        max_similarity[cluster_of[i]] = max(max_similarity[cluster_of[i]], score)
+    clusters = [
+        {"articles": [documents[i]["id"] for i in cluster], "max_similarity": round(max_similarity[number], 3)}
+        for number, cluster in enumerate(clusters)
+    ]
+    covered = [
+        {"topic": documents[t]["text"], "source": documents[t]["id"], "article": documents[p]["id"], "similarity": round(s, 3)}
+        for t, p, s in sorted(find_covered_topics(matrix, kinds, topic_threshold), key=lambda x: x[2], reverse=True)
+    ]
+    return {"clusters": clusters, "covered_topics": covered}
+
+
+def format_report(report: dict) -> str:
+    """
+    Formats the audit result as markdown.
+    """
+    text = "## Duplicated articles\n\n"
+    for cluster in report["clusters"]:
+        text += f"- similarity up to {cluster['max_similarity']}: " + ", ".join(f"`{a}`" for a in cluster["articles"]) + "\n"
+    if not report["clusters"]:
+        text += "No duplicates found :white_check_mark:\n"
+    text += "\n## Covered topics\n\n"
+    for topic in report["covered_topics"]:
+        text += f"- {topic['topic']} ({topic['source']}) -> `{topic['article']}` {topic['similarity']}\n"
+    return text
+
+
+def main():
+    args = parse_cli_args()
+    documents = load_documents(args.posts_dir, args.topics_dir)
+    report = audit(documents, args.threshold, args.topic_threshold)
+    print(format_report(report))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
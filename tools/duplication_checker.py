@@ -7,17 +7,18 @@ Searches for similar texts on the wiki and checks whether a text from a pull req
 import argparse
 import os
 import sys
-import time
 import json
 import re
 from github import Github
 import openai
-from bs4 import BeautifulSoup
-import requests
 
-from tools.llm_utils import remove_plus, count_tokens, trimming_text
-from tools.git import get_pull_request, get_diff_by_url, parse_diff
+from tools.llm_utils import count_tokens, llm_cache, completion_cache_key
+from tools.rate_limit import get_limiter
+from tools.tokens import trim_sections
+from tools.git import get_pull_request, get_diff, parse_diff, DIFF_SOURCES, CONTENT_GLOB
 from tools.utils import logging_decorator
+from tools.attack_index import load_index, find_by_target
+from tools.minhash import MinHasher, LSHIndex
 
 
 def parse_cli_args():
@@ -34,6 +35,9 @@ def parse_cli_args():
     parser.add_argument(
         "--pull-url", dest="pull_url", help="GitHub pull URL", required=True
     )
+    parser.add_argument(
+        "--diff-source", dest="diff_source", help="Where to get the PR diff from", choices=DIFF_SOURCES, default="url"
+    )
     return parser.parse_args()
 
 
@@ -48,38 +52,40 @@ def openai_call(prompt: str, config, retry: int = None):
         retry = config["GPT_retry"]
 
     messages = [{"role": "user", "content": prompt}]
-    try:
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            n=1,
-            stop=None,
-        )
-    except Exception as ex:
-        if retry == 0:
-            raise ex
-        print(ex)
-        print(f"Retry - {retry}, waiting 15 seconds")
-        time.sleep(15)
-        return openai_call(prompt, config, retry - 1)
+    cache_key = completion_cache_key(model, messages, temperature, max_tokens)
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    response = get_limiter("openai").call(
+        openai.ChatCompletion.create,
+        tokens=count_tokens(prompt) + max_tokens,
+        retries=retry,
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        n=1,
+        stop=None,
+    )
 
     ret = response.choices[0].message.content.strip()
+    llm_cache.set(cache_key, ret)
     return ret
 
 
-def new_text_handler(diff):
+def new_text_handler(hunk):
     """
-    Extracts text and target entity from a new pull request
+    Extracts text and target entity from the first content hunk of a new pull request
     """
-    new_text = remove_plus(diff[0]['header'] + diff[0]['body'][0]['body'])
+    new_text = '\n'.join(line.text for line in hunk.added)
     pattern = r'target-entities:\s+(.*?)\n'
     matches = re.search(pattern, new_text)
     target = ''
     if matches:
         target_entities = matches.group(1)
-        target = target_entities
+        # list form of the front matter: "target-entities:\n  - Name"
+        target = target_entities.strip().lstrip('-').strip()
     else:
         print("Value 'target-entities' didn't find")
 
@@ -88,74 +94,79 @@ def new_text_handler(diff):
     return new_text, target
 
 
-def get_list_of_target_entities(url):
+def get_list_of_target_entities(index):
     """
     Gets a list of target entities that exist on the crypto wiki
     """
-    result_list = []
-    response = requests.get(url)
-    if response.status_code == 200:
-        html = response.text
-        soup = BeautifulSoup(html, 'html.parser')
-        li_elements = soup.find_all('li', class_='section-item')
-        for li in li_elements:
-            a_element = li.find('a')
-            if a_element:
-                result_list.append(a_element.text)
-    else:
-        print("Failed to retrieve page content")
-    return result_list
-    
+    entities = set()
+    for entry in index.values():
+        entities.update(entry["target_entities"])
+    return sorted(entities)
+
 
-def get_same_texts(target, url, list_of_target_entities):
+def get_same_texts(target, index, list_of_target_entities):
     """
-    Searching urls of same texts in the crypto wiki
+    Searching paths of same texts in the crypto wiki
     """
-    href_list = []
-    if target in list_of_target_entities:
-        url = url + target
-        response = requests.get(url)
-        if response.status_code == 200:
-            html = response.text
-            soup = BeautifulSoup(html, 'html.parser')
-            posts = soup.find_all('article', class_='markdown book-post')
-            if posts:
-                for post in posts:
-                    post_head = post.find('h2')
-                    href = post_head.find('a')
-                    href = href['href']
-                    href_list.append(href)
-    return href_list
+    if target.lower() not in (x.lower() for x in list_of_target_entities):
+        return []
+    return [entry["path"] for entry in find_by_target(index, target)]
 
 
-def get_old_text(url):
+def get_old_text(path, index):
     """
     Gets an old text from the crypto wiki
     """
-    response = requests.get(url)
-    if response.status_code == 200:
-        html = response.text
-        soup = BeautifulSoup(html, 'html.parser')
-        old_text = soup.get_text()
-        old_text = re.search(r'Summary\n#.*', old_text, re.DOTALL)
-        old_text = old_text.group(0)
-        return old_text
-    else:
-        print("Failed to retrieve page content")
+    return index[path]["text"]
 
 
-def compare_texts(href_list, url, new_text, prompt, config):
+def rank_candidates(new_text, index, same_target_paths=()):
     """
-    Compares a new text from a pull request with old texts
+    Finds texts similar to the new one with MinHash/LSH over the whole wiki.
+    Texts about the same target entity are always ranked.
+    Returns a list of (path, estimated Jaccard similarity) sorted by similarity
     """
-    for href in href_list:
-        url = url + href
-        old_text = get_old_text(url)
+    hasher = MinHasher()
+    lsh = LSHIndex()
+    for path, entry in index.items():
+        lsh.add(path, hasher.signature(entry["text"]))
+    return lsh.query(hasher.signature(new_text), same_target_paths)
+
+
+def select_candidates(candidates, same_target_paths, config):
+    """
+    Picks the texts to compare with the LLM: all texts about the same target entity, however different they look,
+    and the most similar texts about other targets above `LSH_distinct_threshold`, at most `LSH_max_other_candidates`.
+    Returns a list of (path, estimated Jaccard similarity)
+    """
+    similarities = dict(candidates)
+    same_target = sorted(((path, similarities.get(path, 0.0)) for path in same_target_paths),
+                         key=lambda x: x[1], reverse=True)
+    others = [
+        (path, similarity) for path, similarity in candidates
+        if path not in same_target_paths and similarity >= config["LSH_distinct_threshold"]
+    ]
+    return same_target + others[:config["LSH_max_other_candidates"]]
+
+
+def compare_texts(candidates, same_target_paths, index, new_text, prompt, config):
+    """
+    Compares a new text from a pull request with old texts.
+    Near-identical texts are flagged without asking the LLM, see select_candidates() for the texts sent to it
+    """
+    for path, similarity in candidates:
+        if similarity >= config["LSH_duplicate_threshold"]:
+            print(f"{path} is a near-duplicate, estimated similarity {similarity:.2f}")
+            return ":x:"
+    for path, similarity in select_candidates(candidates, same_target_paths, config):
+        print(f"Comparing with {path}, estimated similarity {similarity:.2f}")
+        old_text = get_old_text(path, index)
         amount_of_tokens = count_tokens(prompt % (new_text, old_text))
         if amount_of_tokens > config["max_tokens"]:
             threshold = amount_of_tokens / 2
-            new_text = trimming_text(new_text, threshold)
-            old_text = trimming_text(old_text, threshold)
+            # keep the beginning of every section rather than only the first sections
+            new_text = trim_sections(new_text, threshold)
+            old_text = trim_sections(old_text, threshold)
         query = prompt % (new_text, old_text)
         ans = openai_call(query, config)
         obj = json.loads(ans)
@@ -206,19 +217,23 @@ def main():
     with open('tools/config.json', 'r') as config_file:
         config = json.load(config_file)
 
-    main_url = 'https://dn.institute'
-    target_entities_url = 'https://dn.institute/attacks/posts/target-entities/'
+    index = load_index()
 
     github = Github(args.github_token)
     pr = get_pull_request(github, args.pull_url)
-    _diff = get_diff_by_url(pr)
-    diff = parse_diff(_diff)
-    new_text, target = new_text_handler(diff)
-    list_of_target_entities = get_list_of_target_entities(target_entities_url)
-    href_list = get_same_texts(target, target_entities_url, list_of_target_entities)
-    if href_list:
-        answer = compare_texts(href_list, main_url, new_text, PROMPT, config)
+    _diff = get_diff(pr, args.diff_source)
+    hunk = next(parse_diff(_diff, paths=CONTENT_GLOB), None)
+    if hunk is None:
+        print(f"No {CONTENT_GLOB} file in the diff - exit")
+        return
+    new_text, target = new_text_handler(hunk)
+    list_of_target_entities = get_list_of_target_entities(index)
+    same_target_paths = get_same_texts(target, index, list_of_target_entities)
+    candidates = rank_candidates(new_text, index, same_target_paths)
+    if candidates or same_target_paths:
+        answer = compare_texts(candidates, same_target_paths, index, new_text, PROMPT, config)
         print(answer)
         create_comment_on_pr(pr, answer)
     else:
-        create_comment_on_pr(pr, ":white_check_mark:")
\ No newline at end of file
+        create_comment_on_pr(pr, ":white_check_mark:")
+    print("llm_cache", llm_cache.stats())
\ No newline at end of file
@@ -4,15 +4,20 @@
 Extract and verify statements from text content in a pull request using a LLM model and related search results.
 """
 
-import os, sys, argparse, time
-from typing import List, Tuple, Dict
+import os, sys, argparse
+from typing import List, Tuple, Dict, Callable, Optional, Union, Iterable
+from concurrent.futures import ThreadPoolExecutor, Executor
+import threading
 import json
 from tools.utils import logging_decorator
-from tools.git import get_pull_request, get_diff_by_url
+from tools.llm_utils import llm_cache, completion_cache_key
+from tools.rate_limit import get_limiter
+from tools.git import get_pull_request, get_diff, parse_diff, DIFF_SOURCES
+from itertools import groupby
 from github import Github
 from duckduckgo_search import ddg
 import openai
-import tiktoken
+from tools import tokens
 
 
 # parse arguments
@@ -29,11 +34,18 @@ parser.add_argument(
 
 parser.add_argument("--content-path", dest="content_path", help="Content path")
 parser.add_argument("--mode", dest="mode", help="Run mode")
+parser.add_argument(
+    "--diff-source", dest="diff_source", help="Where to get the PR diff from", choices=DIFF_SOURCES, default="url"
+)
+parser.add_argument(
+    "--workers", dest="workers", help="Number of claims verified in parallel", type=int
+)
 args = parser.parse_args()
 
 openai.api_key = args.openai_key
 
 token_usage = {"prompt": 0, "completion": 0}
+token_usage_lock = threading.Lock()
 
 config = {
     "model": "gpt-3.5-turbo",
@@ -41,16 +53,21 @@ config = {
     "temperature": 0.5,
     "max_tokens": 500,
     "search_size": 10,
+    "workers": 8,  # claims verified in parallel, shared by all files of the PR
+    "file_workers": 4,  # files of the PR processed in parallel
 }
 
 if args.mode == "development":
     config["retry"] = 1
     config["search_size"] = 1
+    config["workers"] = 1
+
+if args.workers:
+    config["workers"] = args.workers
 
 
 def count_tokens(text):
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo-0301")
-    return len(encoding.encode(text))
+    return tokens.count_tokens(text, "gpt-3.5-turbo-0301")
 
 
 def openai_call(
@@ -61,26 +78,30 @@ def openai_call(
     max_tokens: int = config["max_tokens"],
 ):
     messages = [{"role": "user", "content": prompt}]
-    try:
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            n=1,
-            stop=None,
-        )
-    except Exception as ex:
-        if retry == 0:
-            raise (ex)
-        print(ex)
-        print(f"Retry - {retry}, waiting 15 seconds")
-        time.sleep(15)
-        return openai_call(prompt, model, retry - 1)
+    cache_key = completion_cache_key(model, messages, temperature, max_tokens)
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    response = get_limiter("openai").call(
+        openai.ChatCompletion.create,
+        tokens=count_tokens(prompt) + max_tokens,
+        retries=retry,
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        n=1,
+        stop=None,
+    )
 
     ret = response.choices[0].message.content.strip()
-    token_usage["prompt"] += count_tokens(prompt)
-    token_usage["completion"] += count_tokens(ret)
+    llm_cache.set(cache_key, ret)
+    prompt_tokens = count_tokens(prompt)
+    completion_tokens = count_tokens(ret)
+    with token_usage_lock:
+        token_usage["prompt"] += prompt_tokens
+        token_usage["completion"] += completion_tokens
     return ret
 
 
@@ -125,19 +146,12 @@ def fix_uncompleted_json(json_string: str) -> str:
     return json_string + "]"
 
 
-def split_content(diff: str) -> List[Tuple[List[str], str]]:
-    files = diff.split("diff --git")
+def split_content(diff: Union[str, Iterable[str]], paths: Optional[str] = None) -> List[Tuple[List[str], str]]:
     results = []
-    for f in files:
-        if f == "":
-            continue
-        # remove all tech info and stay only changed and append
-        parts = f.split("\n")
-        parts = [x for x in parts if x.startswith("+")]
-        # remove file names
-        parts = [x for x in parts if not x.startswith("+++")]
-        # remove '+' sign from start
-        parts = [x.lstrip("+") for x in parts]
+    hunks = parse_diff(diff, paths=paths, additions_only=True)
+    for _, file_hunks in groupby(hunks, key=lambda hunk: hunk.path):
+        # stay only added lines
+        parts = [line.text for hunk in file_hunks for line in hunk.added]
 
         # Join string between # symbol
         final = []
@@ -169,20 +183,22 @@ def split_content(diff: str) -> List[Tuple[List[str], str]]:
     return results
 
 
-@logging_decorator("Verify claim")
-def verify_claim(claim: Dict, meta: str) -> Tuple[bool, str]:
-    print(f"\nQuery: {meta} {claim['query']}")
+def verify_claim(claim: Dict, meta: str, log: List[str]) -> Tuple[bool, str]:
+    """
+    Verifies a claim with search results, the log lines are appended to `log` instead of printed.
+    """
+    log.append(f"\nQuery: {meta} {claim['query']}")
     summary = web_search(f"{meta} {claim['query']}")
-    print("Summary: " + summary)
+    log.append("Summary: " + summary)
 
-    print("Verify Statement Prompt: " + VERIFY_STATEMENT % (claim["claim"], summary))
+    log.append("Verify Statement Prompt: " + VERIFY_STATEMENT % (claim["claim"], summary))
     ans = openai_call(VERIFY_STATEMENT % (claim["claim"], summary))
     ans = ans.strip().strip("`").strip()
     ans = ans[ans.find("{") :]
-    print("Answer: " + ans)
+    log.append("Answer: " + ans)
 
     obj = json.loads(ans)
-    print("Parsed:", obj)
+    log.append(f"Parsed: {obj}")
 
     is_false = False
     if obj["verdict"] != "true" and obj["verdict"] != True:
@@ -194,74 +210,112 @@ def verify_claim(claim: Dict, meta: str) -> Tuple[bool, str]:
     )
 
 
-@logging_decorator("Verify file")
-def verify_file(parts: List[str], meta: str) -> tuple[int, bool, str]:
-    print(f"\n\nProcessing: {meta} | {len(parts)} splits")
+def run_safely(func: Callable) -> Callable:
+    """
+    Wraps a function so that exceptions are returned instead of raised.
+    Lets a worker pool keep going and the caller log and count failures in submission order.
+    """
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Exception as ex:
+            return ex
+
+    return wrapper
+
+
+def extract_claims(part: str, log: List[str]) -> List[Dict]:
+    """
+    Extracts claims and search queries from a text section, the log lines are appended to `log` instead of printed.
+    """
+    log.append("\nPrompt: " + EXTRACT_STATEMENTS % part)
+    ans = openai_call(EXTRACT_STATEMENTS % part)
+    ans = ans.strip().strip("`").strip()
+    ans = ans[ans.find("[") :]
+    log.append("Answer: " + ans)
+    if ans[-1] != "]":
+        ans = fix_uncompleted_json(ans)
+    claims = json.loads(ans)
+    return list(
+        filter(
+            lambda x: (
+                x
+                and "query" in x
+                and "claim" in x
+                and x["query"] != ""
+                and x["claim"] != ""
+            ),
+            claims,
+        )
+    )
+
+
+def verify_file(parts: List[str], meta: str, executor: Executor) -> tuple[int, bool, str, List[str]]:
+    """
+    Extracts and verifies the claims of a file.
+    Files are processed concurrently, so the log lines are returned to be printed in one block by the caller.
+    """
+    log = [f"\n\nProcessing: {meta} | {len(parts)} splits"]
     # Filter out empty parts
     parts = list(filter(lambda x: (len(x.strip()) > 1), parts))
     exceptions = 0
     had_false_claim = False
     file_comment = ""
 
-    for p in parts:
-        try:
-            print("\nPrompt: " + EXTRACT_STATEMENTS % p)
-            ans = openai_call(EXTRACT_STATEMENTS % p)
-        except Exception as ex:
-            print(ex)
+    # executor.map keeps the submission order, so the comment and the log follow the article.
+    # Each task logs to its own list, which is complete once its result arrives
+    claims = []
+    part_logs = [[] for _ in parts]
+    for result, part_log in zip(executor.map(run_safely(extract_claims), parts, part_logs), part_logs):
+        log += part_log
+        if isinstance(result, Exception):
+            log.append(str(result))
             exceptions += 1
             continue
-        ans = ans.strip().strip("`").strip()
-        ans = ans[ans.find("[") :]
-        print("Answer: " + ans)
-        try:
-            if ans[-1] != "]":
-                ans = fix_uncompleted_json(ans)
-            claims = json.loads(ans)
-            claims = list(
-                filter(
-                    lambda x: (
-                        x
-                        and "query" in x
-                        and "claim" in x
-                        and x["query"] != ""
-                        and x["claim"] != ""
-                    ),
-                    claims,
-                )
-            )
-        except Exception as ex:
-            print(ex)
+        claims += result
+
+    claim_logs = [[] for _ in claims]
+    results = executor.map(run_safely(verify_claim), claims, [meta] * len(claims), claim_logs)
+    for result, claim_log in zip(results, claim_logs):
+        log += claim_log
+        if isinstance(result, Exception):
+            log.append(str(result))
             exceptions += 1
             continue
-        for claim in claims:
-            try:
-                (is_false, comment) = verify_claim(claim, meta)
-                file_comment += comment
-                if is_false:
-                    had_false_claim = True
-            except Exception as ex:
-                print(ex)
-                exceptions += 1
-                continue
+        (is_false, comment) = result
+        file_comment += comment
+        if is_false:
+            had_false_claim = True
+
+    return exceptions, had_false_claim, file_comment, log
 
-    return exceptions, had_false_claim, file_comment
+
+@logging_decorator("Verify file")
+def print_file_log(log: List[str]) -> None:
+    print("\n".join(log))
 
 
 @logging_decorator("Verify statements")
-def verify_statements(diff: str) -> tuple[bool, bool, str]:
-    files = split_content(diff)
+def verify_statements(files: List[Tuple[List[str], str]]) -> tuple[bool, bool, str]:
     comment = ""
     exceptions = 0
     had_false_claim = False
-    for parts, meta in files:
-        file_exceptions, false_claim, file_comment = verify_file(parts, meta)
-        if file_exceptions != 0:
-            print(f"File processing contains {file_exceptions} exceptions")
-        exceptions += file_exceptions
-        if false_claim:
-            had_false_claim = True
-        comment += file_comment
+
+    # Files wait on the claim pool, but claim tasks never wait on files, so the two pools can't deadlock
+    with ThreadPoolExecutor(max_workers=config["workers"]) as claim_executor, \
+            ThreadPoolExecutor(max_workers=config["file_workers"]) as file_executor:
+        results = file_executor.map(
+            lambda file: verify_file(file[0], file[1], claim_executor), files
+        )
+        # each file's log is printed in one block once the file is done
+        for file_exceptions, false_claim, file_comment, log in results:
+            print_file_log(log)
+            if file_exceptions != 0:
+                print(f"File processing contains {file_exceptions} exceptions")
+            exceptions += file_exceptions
+            if false_claim:
+                had_false_claim = True
+            comment += file_comment
 
     return comment, exceptions, had_false_claim
 
@@ -282,14 +336,16 @@ def main():
     is_github_env = True if os.environ.get("GITHUB_ACTIONS") == "true" else False
 
     pr = get_pull_request(github, args.pull_url)
-    diff = get_diff_by_url(pr)
+    diff = get_diff(pr, args.diff_source)
+    content_glob = f"{args.content_path.rstrip('/')}/**.md" if args.content_path else None
+    files = split_content(diff, content_glob)
 
-    if len(diff.strip()) < 1:
+    if not files:
         print("No diff - exit")
         pass
 
     else:
-        _comment, exceptions, had_false_claim = verify_statements(diff)
+        _comment, exceptions, had_false_claim = verify_statements(files)
 
         had_error = exceptions > 0 or had_false_claim
 
@@ -300,6 +356,7 @@ def main():
             print("comment", comment)
 
         print("token_usage", token_usage)
+        print("llm_cache", llm_cache.stats())
 
         if had_error:
             sys.exit(1)
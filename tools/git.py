@@ -1,5 +1,11 @@
 from tools.utils import execute, logging_decorator
+import subprocess
+from typing import Iterable, Iterator, Optional, Union
+from fnmatch import fnmatch
+import io
+import re
 import requests
+from github import GithubException
 
 
 @logging_decorator("Get PR")
@@ -18,23 +24,94 @@ def get_pull_request(github, pull_url: str):
     return pr
 
 
-@logging_decorator("Get Diff From Git")
-def get_diff_by_git(pr, pr_base: str, pr_head: str, subpath: str) -> str:
-    fetch_cmd = ["git", "fetch", "--unshallow", "origin", pr_head]
-    execute(fetch_cmd)
-
-    diff_cmd = [
-        "git",
-        "diff",
-        "--no-prefix",
-        "--unified=0",
-        f"{pr_base}...{pr_head}",
-        "--",
-        subpath,
-        '| egrep "^\+"',
-    ]
-    diff = execute(diff_cmd).stdout
-    return diff
+# fetched commits are pinned under this namespace so they survive gc and are reused by later calls in the same clone
+CACHE_REF_PREFIX = "refs/dni-cache/"
+
+DIFF_SOURCES = ["url", "git"]
+
+
+def has_commit(sha: str) -> bool:
+    """
+    Checks whether a commit is already available in the local repository.
+    """
+    process = subprocess.run(
+        ["git", "cat-file", "-e", f"{sha}^{{commit}}"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return process.returncode == 0
+
+
+def fetch_commits(shas: list[str], depth: int = 1, remote: str = "origin") -> None:
+    """
+    Fetches only the given commits that are missing locally, or whose `depth - 1` ancestors are,
+    e.g. the parent of a merge commit at the edge of a shallow checkout.
+    """
+    missing = [sha for sha in shas if not has_commit(f"{sha}~{depth - 1}")]
+    if not missing:
+        print(f"Commits {', '.join(shas)} are cached locally")
+        return
+    refspecs = [f"+{sha}:{CACHE_REF_PREFIX}{sha}" for sha in missing]
+    execute(["git", "fetch", "--no-tags", f"--depth={depth}", remote, *refspecs])
+
+
+@logging_decorator("Fetch PR commits")
+def fetch_diff_commits(pr) -> Optional[tuple[str, str]]:
+    """
+    Fetches the commits to diff and returns them as (base, head).
+    Uses the test merge commit of the PR when GitHub provides one, so only that commit and its parents are fetched.
+    Otherwise the head is compared with its merge base, like `git diff base...head`, so changes made on the base
+    branch after the PR branched off are left out. Returns None if GitHub can't tell the merge base.
+    """
+    if pr.merge_commit_sha:
+        fetch_commits([pr.merge_commit_sha], depth=2)
+        return f"{pr.merge_commit_sha}^1", pr.merge_commit_sha
+    try:
+        merge_base = pr.base.repo.compare(pr.base.sha, pr.head.sha).merge_base_commit.sha
+    except GithubException as ex:
+        print(f"Can't get the merge base of {pr.base.sha} and {pr.head.sha}: {ex}")
+        return None
+    fetch_commits([merge_base, pr.head.sha])
+    return merge_base, pr.head.sha
+
+
+def get_diff_by_git(pr, subpath: Optional[str] = None) -> Union[str, Iterator[str]]:
+    """
+    Computes the PR diff with the local git and streams its lines, see fetch_diff_commits().
+    Falls back to the URL diff if the commits to diff can't be found.
+    The diff runs while the lines are consumed, so it is not wrapped in a log group.
+    """
+    commits = fetch_diff_commits(pr)
+    if commits is None:
+        return get_diff_by_url(pr)
+    base, head = commits
+
+    diff_cmd = ["git", "diff", "--unified=0", "--no-color", base, head]
+    if subpath:
+        diff_cmd += ["--", subpath]
+    print(f"Executing: {' '.join(diff_cmd)}")
+    return _stream_lines(diff_cmd)
+
+
+def _stream_lines(cmd: list[str]) -> Iterator[str]:
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True, encoding="utf-8")
+    try:
+        yield from process.stdout
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def get_diff(pr, source: str = "url", subpath: Optional[str] = None) -> Union[str, Iterator[str]]:
+    """
+    Gets the PR diff from the chosen source: "url" downloads it from GitHub, "git" computes it locally.
+    The result can be passed to parse_diff() either way.
+    """
+    if source == "git":
+        return get_diff_by_git(pr, subpath)
+    return get_diff_by_url(pr)
 
 
 @logging_decorator("Get Diff From URL")
@@ -54,33 +131,120 @@ def get_diff_by_url(pr) -> str:
     return diff
 
 
-@logging_decorator("Parse Diff")
-def parse_diff(diff: str) -> list[dict]:
-    # split into files
-    raw_files = diff.split("diff --git ")
-    raw_files.remove(raw_files[0])  # remove first element which is empty
-
-    # construct files as dictionaries
-    files = []
-    for raw_file in raw_files:
-        # split into segments
-        raw_segments = raw_file.split("@@")
-
-        # pop and store file header
-        file_header = raw_segments.pop(0)
-
-        # construct segments as dictionaries
-        segments = []
-        for index, seg in enumerate(raw_segments):
-            if index % 2 == 0:
-                segment = {
-                    "header": raw_segments[index],
-                    "body": raw_segments[index + 1],
-                }
-                segments.append(segment)
-
-        file = {"header": file_header, "body": segments}
-        files.append(file)
-
-    print(files)
-    return files
+CONTENT_GLOB = "content/**.md"
+
+HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+class DiffLine:
+    """
+    An added or removed line. `number` is the line number in the new file for additions
+    and in the old file for removals.
+    """
+    __slots__ = ("number", "text")
+
+    def __init__(self, number: int, text: str):
+        self.number = number
+        self.text = text
+
+    def __repr__(self):
+        return f"DiffLine({self.number}, {self.text!r})"
+
+
+class Hunk:
+    """
+    A hunk of a file diff with its line ranges and changed lines.
+    """
+    __slots__ = ("path", "old_start", "old_count", "new_start", "new_count", "added", "removed")
+
+    def __init__(self, path: str, old_start: int, old_count: int, new_start: int, new_count: int):
+        self.path = path
+        self.old_start = old_start
+        self.old_count = old_count
+        self.new_start = new_start
+        self.new_count = new_count
+        self.added: list[DiffLine] = []
+        self.removed: list[DiffLine] = []
+
+    def __repr__(self):
+        return (f"Hunk({self.path!r}, -{self.old_start},{self.old_count} +{self.new_start},{self.new_count}, "
+                f"{len(self.added)} added, {len(self.removed)} removed)")
+
+
+def _strip_prefix(path: str) -> Optional[str]:
+    path = path.rstrip("\n").split("\t")[0]
+    if path == "/dev/null":
+        return None
+    if path.startswith(("a/", "b/")):
+        return path[2:]
+    return path
+
+
+def parse_diff(source: Union[str, Iterable[str]], paths: Union[str, list[str], None] = None,
+               additions_only: bool = False) -> Iterator[Hunk]:
+    """
+    Parses a unified diff lazily and yields one Hunk at a time.
+
+    :param source: Diff text, or any iterable of lines such as an open file or a process stdout.
+    :param paths: Glob pattern(s), e.g. `content/**.md`; hunks of other files are skipped.
+    :param additions_only: Don't keep removed lines.
+    """
+    if isinstance(source, str):
+        source = io.StringIO(source)
+    if isinstance(paths, str):
+        paths = [paths]
+
+    old_path = new_path = None
+    wanted = False
+    hunk = None
+    old_left = new_left = 0
+    old_number = new_number = 0
+
+    for line in source:
+        line = line.rstrip("\r\n")
+
+        if hunk is not None:
+            # hunk bodies are consumed by their line counts, so content such as "@@" can't break parsing
+            if line.startswith("+"):
+                hunk.added.append(DiffLine(new_number, line[1:]))
+                new_number += 1
+                new_left -= 1
+            elif line.startswith("-"):
+                if not additions_only:
+                    hunk.removed.append(DiffLine(old_number, line[1:]))
+                old_number += 1
+                old_left -= 1
+            elif line.startswith("\\"):
+                continue  # "\ No newline at end of file"
+            else:
+                old_number += 1
+                new_number += 1
+                old_left -= 1
+                new_left -= 1
+            if old_left <= 0 and new_left <= 0:
+                if wanted:
+                    yield hunk
+                hunk = None
+            continue
+
+        if line.startswith("diff --git "):
+            old_path = new_path = None
+            wanted = False
+        elif line.startswith("--- "):
+            old_path = _strip_prefix(line[4:])
+        elif line.startswith("+++ "):
+            new_path = _strip_prefix(line[4:])
+            path = new_path or old_path
+            wanted = paths is None or any(fnmatch(path, pattern) for pattern in paths)
+        elif line.startswith("@@"):
+            match = HUNK_HEADER.match(line)
+            if not match:
+                continue
+            old_start, old_count, new_start, new_count = match.groups()
+            old_count = 1 if old_count is None else int(old_count)
+            new_count = 1 if new_count is None else int(new_count)
+            hunk = Hunk(new_path or old_path, int(old_start), old_count, int(new_start), new_count)
+            old_number, new_number = int(old_start), int(new_start)
+            old_left, new_left = old_count, new_count
+            if old_left == 0 and new_left == 0:
+                hunk = None
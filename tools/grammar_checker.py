@@ -6,14 +6,18 @@ Check Grammar mistakes in a Github PR and comment on the PR.
 
 __author__ = "Daniel Souza <me@posix.dev.br>"
 
-import os, argparse, time
+import os, argparse, re
+from concurrent.futures import ThreadPoolExecutor
 from github import Github, GithubException
 from tools.utils import logging_decorator
-from tools.git import get_pull_request, get_diff_by_url, parse_diff
+from tools.git import get_pull_request, get_diff, parse_diff, DIFF_SOURCES, Hunk, CONTENT_GLOB
+from typing import Iterable
+from tools.llm_utils import llm_cache, completion_cache_key
+from tools.rate_limit import get_limiter
 from pylanguagetool import api
 from pylanguagetool import converters
 import openai
-import tiktoken
+from tools import tokens
 
 TOKEN_LIMIT = 8191
 TOKEN_PENALTY = 500
@@ -24,6 +28,8 @@ CONFIG = {
     "temperature": 0,
     "max_tokens": 4000,
     "search_size": 10,
+    "chunk_tokens": 3000,  # article tokens per request for articles that don't fit in one request
+    "workers": 4,
 }
 
 SYSTEM_PROMPT = """
@@ -40,6 +46,11 @@ USER_PROMPT = """
 Task: Suggest grammar issues on provided MD formatted article:
 """
 
+CHUNK_NOTE = """This is part %d of %d of the article, it contains the sections: %s.
+Only report a Missing Header Issue if this part starts with the metadata header between --- lines.
+
+"""
+
 
 def parse_cli_args():
     """
@@ -58,34 +69,23 @@ def parse_cli_args():
         "--openai-key", dest="openai_key", help="OpenAI API key", required=True
     )
 
+    parser.add_argument(
+        "--diff-source", dest="diff_source", help="Where to get the PR diff from", choices=DIFF_SOURCES, default="url"
+    )
     return parser.parse_args()
 
 
-def get_content(diff: list[dict]) -> int:
+def get_content(diff: Iterable[Hunk]) -> str:
     """
     Collecting content from Github PR diff.
     Returns the parsed raw text
     """
 
-    content = ''
-
-    for file in diff:
-        for segments in file["body"]:
-            for line in segments["body"].splitlines():
-                # only count line additions
-                if line.startswith("+"):
-                    # sanitize line
-                    line = line[1:]  # rm addition indicator
-                    line = line.strip()  # rm leading/trailing whitespace
-
-                    # filling the content for further check
-                    content += line + '\n'
-
-    return content 
+    # only added lines, stripped of leading/trailing whitespace
+    return ''.join(line.text.strip() + '\n' for hunk in diff for line in hunk.added)
 
 def count_tokens(text):
-    encoding = tiktoken.encoding_for_model("gpt-4-0613")
-    return len(encoding.encode(text))
+    return tokens.count_tokens(text, CONFIG["model"])
 
 
 def openai_call(
@@ -99,42 +99,140 @@ def openai_call(
     messages.append({"role": "user", "content": USER_PROMPT})
     messages.append({"role": "user", "content": prompt})
 
-    try:
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
-            n=1,
-            stop=None,
-        )
-    except Exception as ex:
-        if retry == 0:
-            raise (ex)
-        print(ex)
-        print(f"Retry - {retry}, waiting 15 seconds")
-        time.sleep(15)
-        return openai_call(prompt, model, retry - 1)
+    cache_key = completion_cache_key(model, messages, temperature, max_tokens)
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    response = get_limiter("openai").call(
+        openai.ChatCompletion.create,
+        tokens=sum(count_tokens(m["content"]) for m in messages) + max_tokens,
+        retries=retry,
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        n=1,
+        stop=None,
+    )
 
     ret = response.choices[0].message.content.strip()
+    llm_cache.set(cache_key, ret)
 
     return ret
 
+def section_name(section: str) -> str:
+    """
+    Returns the heading of a markdown section, the text before the first heading is the metadata header.
+    """
+    first_line = section.lstrip().split("\n", 1)[0]
+    if first_line.startswith("#"):
+        return first_line.lstrip("#").strip()
+    return "Metadata"
+
+
+def split_oversized(text: str, budget: int) -> list[str]:
+    """
+    Splits a section that alone exceeds the budget on paragraphs, cutting single paragraphs on token boundaries.
+    """
+    pieces = []
+    current = ""
+    for paragraph in re.split(r"(?<=\n)\n", text):
+        if count_tokens(current + paragraph) <= budget:
+            current += paragraph
+            continue
+        if current:
+            pieces.append(current)
+        while count_tokens(paragraph) > budget:
+            head = tokens.trim_tokens(paragraph, budget, CONFIG["model"])
+            if not head:
+                break
+            pieces.append(head)
+            paragraph = paragraph[len(head):]
+        current = paragraph
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def chunk_content(content: str, budget: int) -> list[tuple[list[str], str]]:
+    """
+    Packs consecutive markdown sections into chunks of at most `budget` tokens.
+    Returns a list of (section names, chunk text)
+    """
+    sections = tokens.split_sections(content)
+    counts = tokens.count_tokens_batch(sections, CONFIG["model"])
+    chunks = []
+    names, text, used = [], "", 0
+    for section, count in zip(sections, counts):
+        if used + count > budget and text:
+            chunks.append((names, text))
+            names, text, used = [], "", 0
+        if count > budget:
+            for piece in split_oversized(section, budget):
+                chunks.append(([section_name(section)], piece))
+            continue
+        names.append(section_name(section))
+        text += section
+        used += count
+    if text:
+        chunks.append((names, text))
+    return chunks
+
+
+def check_chunk(prompt: str) -> tuple[str, int]:
+    """
+    Checks a single chunk and returns the issues with the number of used tokens.
+    """
+    token_usage = sum(tokens.count_tokens_batch([SYSTEM_PROMPT, USER_PROMPT, prompt], CONFIG["model"]))
+    issues = openai_call(prompt, max_tokens=TOKEN_LIMIT - token_usage)
+    return issues, token_usage + count_tokens(issues)
+
+
+def merge_issues(results: list[tuple[list[str], str]]) -> str:
+    """
+    Merges the issue lists of all chunks, dropping duplicates and adding section references.
+    """
+    merged = {}
+    for names, issues in results:
+        for line in issues.splitlines():
+            if not re.match(r"^\s*([-*]|\d+\.)\s+", line):
+                continue
+            key = re.sub(r"\W+", " ", line).strip().lower()
+            sections = merged.setdefault(key, (line.rstrip(), []))[1]
+            if "section" not in line.lower():
+                sections.extend(name for name in names if name not in sections)
+
+    return "\n".join(
+        f"{line} in *{', '.join(sections)}* section" if sections else line
+        for line, sections in merged.values()
+    )
+
+
 def grammar_check(content):
-    token_usage = count_tokens(SYSTEM_PROMPT) + count_tokens(USER_PROMPT) + count_tokens(content)
+    prompt_tokens = sum(tokens.count_tokens_batch([SYSTEM_PROMPT, USER_PROMPT], CONFIG["model"]))
+    limit = TOKEN_LIMIT - TOKEN_PENALTY - prompt_tokens
+
+    # Articles that fit in one request are checked in one, exactly as before
+    if count_tokens(content) <= limit:
+        issues, token_usage = check_chunk(content)
+        print("token_usage", token_usage)
+        return issues
+
+    budget = min(CONFIG["chunk_tokens"], limit)
+    chunks = chunk_content(content, budget)
+    prompts = [
+        CHUNK_NOTE % (i + 1, len(chunks), ", ".join(names)) + text
+        for i, (names, text) in enumerate(chunks)
+    ]
+    print(f"Content exceeds {limit} tokens, checking {len(chunks)} parts")
 
-    # If requested tokens exceeds token penalty, raise an error
-    if(TOKEN_LIMIT - token_usage > TOKEN_PENALTY):
-        issues = openai_call(content, max_tokens=TOKEN_LIMIT-token_usage)
-        token_usage += count_tokens(issues)
-    else:
-        print("Token Limit exceeded!")
-        print(f"Token Limit exceeded! {token_usage} tokens were requested while the token limit is {TOKEN_LIMIT}")
-        return ""
+    with ThreadPoolExecutor(max_workers=CONFIG["workers"]) as executor:
+        results = list(executor.map(check_chunk, prompts))
 
-    print("token_usage", token_usage)
+    print("token_usage", sum(used for _, used in results))
 
-    return issues
+    return merge_issues([(names, issues) for (names, _), (issues, _) in zip(chunks, results)])
 
 @logging_decorator("Comment on PR")
 def create_comment(
@@ -167,11 +265,12 @@ def main():
 
     openai.api_key = args.openai_key
 
-    _diff = get_diff_by_url(pr)
-    diff = parse_diff(_diff)
+    _diff = get_diff(pr, args.diff_source)
+    diff = parse_diff(_diff, paths=CONTENT_GLOB)
     content = get_content(diff)
 
     issues = grammar_check(content)
 
     # Creating actual comment with Grammar mistakes
     create_comment(pr, issues)
+    print("llm_cache", llm_cache.stats())
@@ -1,6 +1,19 @@
 import re
 import json
-import tiktoken
+
+from tools.cache import DiskCache, hash_key
+from tools.tokens import count_tokens, trim_tokens
+
+
+# Completions are deterministic enough for re-runs on the same PR, keep them for two weeks and at most 100 MB
+llm_cache = DiskCache("llm", max_age=14 * 24 * 3600, max_size=100 * 1024 * 1024)
+
+
+def completion_cache_key(model: str, messages, temperature: float, max_tokens: int) -> str:
+    """
+    Builds a cache key for an LLM completion request.
+    """
+    return hash_key(model, messages, temperature, max_tokens)
 
 
 def extract_json(text):
@@ -21,16 +34,5 @@ def remove_plus(text):
     return '\n'.join(line.lstrip('+') for line in text.split('\n'))
 
 
-def count_tokens(text):
-    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    return len(encoding.encode(text))
-
-
 def trimming_text(text, threshold):
-    token_count = count_tokens(text)
-    while token_count > threshold:
-        tokens = text.split()
-        tokens = tokens[:-1]
-        text = ' '.join(tokens)
-        token_count = count_tokens(text)
-    return text
\ No newline at end of file
+    return trim_tokens(text, threshold)
\ No newline at end of file
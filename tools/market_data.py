@@ -0,0 +1,175 @@
+"""
+Hourly market metrics from the cross-market surveillance API.
+
+The API returns at most `PAGE_LIMIT` records per request, so a range is split into windows of that many hours.
+Windows are fetched concurrently over a pooled session and merged in timestamp order.
+Responses are parsed as they stream in and every record goes straight into typed column arrays,
+so a multi-year pull never holds the raw JSON or a list of record dicts in memory.
+"""
+
+import os
+import json
+import codecs
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from tools.market_store import TIMESTAMP, ColumnBuilder, concat_columns, merge_schemas, to_hour, from_hour
+
+
+# can point to a local stub of the endpoint
+API_URL = os.environ.get("MARKET_API_URL", "https://cross-market-surveillance.p.rapidapi.com/metrics/wt/market")
+API_HOST = "cross-market-surveillance.p.rapidapi.com"
+GRANULARITY = "1h"
+STEP = timedelta(hours=1)
+PAGE_LIMIT = 1000
+FETCH_WORKERS = 4
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_timestamp(value: str) -> datetime:
+    """
+    Parses API timestamps like `2023-12-19T10:00:00.000Z` and query bounds like `2023-12-19T00:00:00`.
+    """
+    return datetime.strptime(value[:19], TIMESTAMP_FORMAT)
+
+
+def format_timestamp(value: datetime) -> str:
+    return value.strftime(TIMESTAMP_FORMAT)
+
+
+def create_session(workers: int = FETCH_WORKERS) -> requests.Session:
+    """
+    Creates a session that keeps up to `workers` connections alive and retries rate limits and server errors.
+    """
+    retry = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=["GET"], respect_retry_after_header=True)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def split_windows(start: datetime, end: datetime, limit: int = PAGE_LIMIT, step: timedelta = STEP) -> list[tuple[datetime, datetime]]:
+    """
+    Splits [start, end) into consecutive windows of at most `limit` records.
+    """
+    windows = []
+    while start < end:
+        windows.append((start, min(start + limit * step, end)))
+        start = windows[-1][1]
+    return windows
+
+
+def iter_json_array(chunks: Iterable[bytes]) -> Iterator:
+    """
+    Yields the items of a JSON array as its bytes arrive, keeping only the unparsed tail in memory.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer, position, started = "", 0, False
+    for chunk in chunks:
+        buffer = buffer[position:] + text.decode(chunk)
+        position = 0
+        while True:
+            while position < len(buffer) and (buffer[position].isspace() or (started and buffer[position] == ",")):
+                position += 1
+            if position == len(buffer):
+                break
+            if not started:
+                if buffer[position] != "[":
+                    raise ValueError(f"Expected a JSON array, got: {buffer[position:position + 200]}")
+                started = True
+                position += 1
+                continue
+            if buffer[position] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break  # the item continues in the next chunk
+            if end == len(buffer) and not isinstance(item, (dict, list)):
+                break  # a number at the end of the buffer may have more digits
+            yield item
+            position = end
+    raise ValueError("Incomplete JSON array")
+
+
+def fetch_window(session: requests.Session, url: str, headers: dict, params: dict, start: datetime, end: datetime,
+                 limit: int = PAGE_LIMIT, step: timedelta = STEP) -> ColumnBuilder:
+    """
+    Fetches the records of one window into columns, following up with more requests if a page comes back full.
+    """
+    builder = ColumnBuilder(capacity=min(limit, max((end - start) // step, 1)))
+    while start < end:
+        with session.get(url, headers=headers, timeout=60, stream=True, params={
+            **params,
+            "start": format_timestamp(start),
+            "end": format_timestamp(end),
+            "limit": str(limit),
+        }) as response:
+            response.raise_for_status()
+            page_size, last = 0, None
+            for record in iter_json_array(response.iter_content(CHUNK_SIZE)):
+                builder.append(record)
+                page_size, last = page_size + 1, record[TIMESTAMP]
+        if page_size < limit:
+            break
+        start = parse_timestamp(last) + step
+    return builder
+
+
+def merge_columns(parts: list[ColumnBuilder], start: datetime, end: datetime) -> tuple[dict[str, np.ndarray], dict]:
+    """
+    Merges fetched windows in timestamp order, dropping rows repeated at window bounds and rows outside [start, end).
+    Returns the columns and their schema.
+    """
+    schema, columns = {}, {TIMESTAMP: np.empty(0, dtype=np.int64)}
+    for part in parts:
+        schema = merge_schemas(schema, part.schema)
+        columns = concat_columns(columns, part.finish())
+    hours = columns[TIMESTAMP]
+    inside = np.flatnonzero((hours >= to_hour(start)) & (hours < to_hour(end)))
+    order = inside[np.argsort(hours[inside], kind="stable")]
+    # of rows with the same hour the last fetched one is kept
+    ordered = hours[order]
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = ordered[1:] != ordered[:-1]
+    order = order[last]
+    return {name: array[order] for name, array in columns.items()}, schema
+
+
+def find_gaps(hours: np.ndarray, start: datetime, end: datetime) -> list[tuple[datetime, datetime]]:
+    """
+    Returns the [from, to) intervals of the range that have no rows, `hours` are sorted and unique.
+    """
+    bounds = np.concatenate([[to_hour(start) - 1], hours, [to_hour(end)]])
+    gaps = np.flatnonzero(np.diff(bounds) > 1)
+    return [(from_hour(bounds[i] + 1), from_hour(bounds[i + 1])) for i in gaps]
+
+
+def fetch_market_data(headers: dict, marketvenueid: str, pairid: str, start: datetime, end: datetime,
+                      url: str = API_URL, workers: int = FETCH_WORKERS) -> tuple[dict[str, np.ndarray], dict]:
+    """
+    Fetches hourly metrics of a market for [start, end) in concurrent windows.
+    Returns columns as described in `tools.market_store` and their schema.
+    """
+    params = {"marketvenueid": marketvenueid, "pairid": pairid, "gran": GRANULARITY, "sort": "asc"}
+    windows = split_windows(start, end)
+    with create_session(workers) as session, ThreadPoolExecutor(max_workers=workers) as executor:
+        parts = list(executor.map(lambda window: fetch_window(session, url, headers, params, *window), windows))
+    columns, schema = merge_columns(parts, start, end)
+
+    gaps = find_gaps(columns[TIMESTAMP], start, end)
+    if gaps:
+        missing = sum((to - since) // STEP for since, to in gaps)
+        print(f"Warning: {missing} hours without data in {len(gaps)} gaps, first: "
+              f"{format_timestamp(gaps[0][0])} - {format_timestamp(gaps[0][1])}")
+    print(f"Fetched {len(columns[TIMESTAMP])} records in {len(windows)} windows")
+    return columns, schema
@@ -0,0 +1,201 @@
+#!/bin/env python
+
+"""
+Writes market health reports for many venues, pairs and periods in one run.
+
+The batch file lists explicit `reports` and/or a matrix of `venues` x `pairs` x `periods`:
+
+    {
+        "venues": ["binance", "huobi"],
+        "pairs": ["btc-usdt", "doge-usdt"],
+        "periods": [["2024-01-01", "2024-01-08"], {"days": 7}],
+        "reports": [{"venue": "okx", "pair": "sol-usdt", "start": "2024-01-01", "end": "2024-02-01"}]
+    }
+
+`{"days": N}` is the last N days before today (UTC). Market data is fetched once per market for the union of
+its periods, with several markets in flight. The articles are written by a bounded number of threads sharing the
+prompts, the tokenizer and the rate limiter. The charts of all reports are rendered in one process pool.
+Reports whose inputs didn't change since the last run are skipped (see `tools.report_manifest`).
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional
+import openai
+
+from tools.market_data import API_URL, API_HOST, fetch_market_data
+from tools.market_health_reporter import (
+    DATA_DIR, REPO_NAME, TOO_LONG_MESSAGE, load_prompts, period_range, post_comment_to_issue, report_dir,
+    write_article,
+)
+from tools.market_store import TIMESTAMP, MarketStore, merge_intervals, to_hour, from_hour
+from tools.report_graphics_tool import Visualization, DPI, FORMAT
+from tools.report_manifest import ReportManifest
+
+
+BATCH_FILE = "tools/market_health_reporter_doc/batch.json"
+# markets fetched at once, each of them also fetches `market_data.FETCH_WORKERS` windows at once
+FETCH_WORKERS = 2
+# reports whose article is being written at once, the OpenAI rate limiter is shared by all of them
+LLM_WORKERS = 4
+
+
+def parse_cli_args():
+    """
+    Parse CLI arguments.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--llm-api-key", dest="API_key", help="LLM API key", required=True
+    )
+    parser.add_argument(
+        "--rapid-api", dest="rapid_api", help="Rapid API key", required=True
+    )
+    parser.add_argument(
+        "--batch", dest="batch", help="JSON file with the reports to write", default=BATCH_FILE
+    )
+    parser.add_argument(
+        "--github-token", dest="github_token", help="Github token, to post the results to --issue"
+    )
+    parser.add_argument(
+        "--issue", dest="issue", help="Issue number to post the results to"
+    )
+    parser.add_argument(
+        "--api-url", dest="api_url", help="Market metrics endpoint", default=API_URL
+    )
+    parser.add_argument(
+        "--fetch-workers", dest="fetch_workers", help="Markets fetched at once", type=int, default=FETCH_WORKERS
+    )
+    parser.add_argument(
+        "--llm-workers", dest="llm_workers", help="Articles written at once", type=int, default=LLM_WORKERS
+    )
+    parser.add_argument(
+        "--chart-dpi", dest="chart_dpi", help="Resolution of the charts", type=int, default=DPI
+    )
+    parser.add_argument(
+        "--chart-format", dest="chart_format", help="File format of the charts, e.g. png or svg", default=FORMAT
+    )
+    return parser.parse_args()
+
+
+def parse_period(period, today: date) -> tuple[str, str]:
+    """
+    Returns the (start, end) dates of a `[start, end]` pair or of `{"days": N}` ending today.
+    """
+    if isinstance(period, dict):
+        return (today - timedelta(days=int(period["days"]))).isoformat(), today.isoformat()
+    start, end = period
+    return start.strip(), end.strip()
+
+
+def expand_batch(batch: dict, today: Optional[date] = None) -> list[tuple[str, str, str, str]]:
+    """
+    Lists the distinct (marketvenueid, pairid, start, end) reports of a batch in their order in the file.
+    """
+    today = today or datetime.now(timezone.utc).date()
+    reports = [
+        (report["venue"], report["pair"], *parse_period([report["start"], report["end"]], today))
+        for report in batch.get("reports", [])
+    ]
+    reports += [
+        (venue, pair, *parse_period(period, today))
+        for venue in batch.get("venues", [])
+        for pair in batch.get("pairs", [])
+        for period in batch.get("periods", [])
+    ]
+    reports = [(venue.strip().lower(), pair.strip().lower(), start, end) for venue, pair, start, end in reports]
+    return list(dict.fromkeys(reports))
+
+
+def update_market(headers: dict, url: str, marketvenueid: str, pairid: str, periods: list[tuple[str, str]]) -> None:
+    """
+    Fetches the hours of the periods that are not in the store yet, overlapping periods are fetched once.
+    """
+    store = MarketStore(DATA_DIR, marketvenueid, pairid)
+    missing = merge_intervals([
+        [to_hour(missing_start), to_hour(missing_end)]
+        for period in periods
+        for missing_start, missing_end in store.missing(*period_range(*period))
+    ])
+    for missing_start, missing_end in missing:
+        print(f"Fetching {marketvenueid} {pairid} data from {from_hour(missing_start)} to {from_hour(missing_end)}")
+        columns, schema = fetch_market_data(headers, marketvenueid, pairid, from_hour(missing_start),
+                                            from_hour(missing_end), url)
+        store.add(columns, schema, from_hour(missing_start), from_hour(missing_end))
+
+
+def update_stores(headers: dict, url: str, reports: list[tuple[str, str, str, str]], workers: int) -> dict:
+    """
+    Updates the stores of all markets of the reports concurrently. Returns the error of each market that failed.
+    """
+    markets = {}
+    for marketvenueid, pairid, start, end in reports:
+        markets.setdefault((marketvenueid, pairid), []).append((start, end))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            market: executor.submit(update_market, headers, url, *market, periods)
+            for market, periods in markets.items()
+        }
+    errors = {}
+    for market, future in futures.items():
+        if future.exception() is not None:
+            errors[market] = future.exception()
+            print(f"Error fetching {' '.join(market)}: {future.exception()}")
+    return errors
+
+
+def run_report(report: tuple[str, str, str, str], prompts: dict, vis: Visualization, charts: ProcessPoolExecutor) -> str:
+    """
+    Writes the article and renders the charts of one report, returns its status.
+    """
+    marketvenueid, pairid, start, end = report
+    store = MarketStore(DATA_DIR, marketvenueid, pairid)
+    data = store.columns(*period_range(start, end))
+    if not len(data.get(TIMESTAMP, ())):
+        return "no data"
+    output_subdir = report_dir(marketvenueid, pairid, start, end)
+    manifest = ReportManifest(output_subdir)
+    output = write_article(data, store.meta["schema"], prompts, marketvenueid, pairid, start, end, manifest)
+    if output is None:
+        return TOO_LONG_MESSAGE
+    vis.generate_report(data, output_subdir, manifest, executor=charts)
+    return f"written to {output_subdir}"
+
+
+def main():
+    args = parse_cli_args()
+    with open(args.batch, "r", encoding="utf-8") as file:
+        reports = expand_batch(json.load(file))
+    print(f"{len(reports)} reports")
+
+    headers = {"X-RapidAPI-Key": args.rapid_api, "X-RapidAPI-Host": API_HOST}
+    errors = update_stores(headers, args.api_url, reports, args.fetch_workers)
+
+    openai.api_key = args.API_key
+    prompts = load_prompts()
+    vis = Visualization(dpi=args.chart_dpi, fmt=args.chart_format)
+    results = {}
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as charts:
+        # the chart workers are started before the article threads, forking a process with running threads can deadlock
+        charts.submit(os.getpid).result()
+        with ThreadPoolExecutor(max_workers=args.llm_workers) as executor:
+            futures = {
+                report: executor.submit(run_report, report, prompts, vis, charts)
+                for report in reports if report[:2] not in errors
+            }
+            for report in reports:
+                if report[:2] in errors:
+                    results[report] = f"fetch failed: {errors[report[:2]]}"
+                    continue
+                try:
+                    results[report] = futures[report].result()
+                except Exception as e:
+                    results[report] = f"failed: {e}"
+
+    summary = "\n".join(f"- {' '.join(report)}: {status}" for report, status in results.items())
+    print(summary)
+    if args.github_token and args.issue:
+        post_comment_to_issue(args.github_token, int(args.issue), REPO_NAME, summary)
@@ -1,13 +1,24 @@
 import openai
-from tiktoken import encoding_for_model
+from tools.tokens import get_encoding
 import argparse
 import json
 import os
-import requests
 import glob
+from typing import Optional
+from datetime import datetime
 from github import Github
 from tools.utils import read_file, extract_between_tags
-from tools.report_graphics_tool import Visualization
+from tools.rate_limit import get_limiter
+from tools.report_graphics_tool import Visualization, DPI, FORMAT
+from tools.market_data import API_URL, API_HOST, fetch_market_data, parse_timestamp
+from tools.market_store import MarketStore, columns_hash
+from tools.market_summary import summarize
+from tools.report_manifest import ReportManifest, source_hash
+from tools.cache import hash_key
+import tools.benford
+import tools.market_store
+import tools.market_summary
+import tools.tokens
 
 
 REPO_NAME = "Kseymur/dn-institute"
@@ -17,6 +28,11 @@ ARTICLE_EXAMPLE_FILE = 'content/market-health/posts/2023-08-14-huobi/index.md'
 OUTPUT_DIR = 'content/market-health/posts/'
 DATA_DIR = 'tools/market_health_reporter_doc/data/'
 MAX_TOKENS = 125000
+# the data is summarized to fit this budget, the rest is left for the instructions and the article example
+DATA_TOKENS = 30000
+LLM_MODEL = "gpt-4-0125-preview"
+LLM_TEMPERATURE = 0.0
+TOO_LONG_MESSAGE = "Your request is too long. It's possible that the period for the data is too broad. Please narrow it down."
 
 
 def parse_cli_args():
@@ -39,6 +55,15 @@ def parse_cli_args():
     parser.add_argument(
         "--rapid-api", dest="rapid_api", help="Rapid API key", required=True
     )
+    parser.add_argument(
+        "--api-url", dest="api_url", help="Market metrics endpoint", default=API_URL
+    )
+    parser.add_argument(
+        "--chart-dpi", dest="chart_dpi", help="Resolution of the charts", type=int, default=DPI
+    )
+    parser.add_argument(
+        "--chart-format", dest="chart_format", help="File format of the charts, e.g. png or svg", default=FORMAT
+    )
     return parser.parse_args()
 
 
@@ -53,10 +78,18 @@ def extract_data_from_comment(comment: str) -> tuple:
     return marketvenueid, pairid, start, end
 
 
-def save_output(output: str, directory: str, marketvenueid: str, pairid: str, start: str, end: str) -> None:
+def save_output(output: str, directory: str, marketvenueid: str, pairid: str, start: str, end: str,
+                file_path: Optional[str] = None) -> str:
     """
     Saves the output to a markdown file in the specified directory, creating a subdirectory for it.
+    Overwrites `file_path` if given, otherwise writes the next free `index-N.md`. Returns the path of the file.
     """
+    if file_path is not None:
+        with open(file_path, 'w', encoding='utf-8') as file:
+            file.write(output)
+        print(f"Output saved to: {file_path}")
+        return file_path
+
     output_subdir = os.path.join(directory, f"{start}-{end}-{marketvenueid}-{pairid}")  
     os.makedirs(output_subdir, exist_ok=True)  
     safe_start = start.replace(":", "-")
@@ -75,43 +108,28 @@ def save_output(output: str, directory: str, marketvenueid: str, pairid: str, st
     with open(full_path, 'w', encoding='utf-8') as file:
         file.write(output)
     print(f"Output saved to: {full_path}")
+    return full_path
 
 
-def save_data(data: str, directory: str, marketvenueid: str, pairid: str, start: str, end: str) -> None:
+def period_range(start: str, end: str) -> tuple[datetime, datetime]:
     """
-    Saves data to a JSON file in the specified directory.
+    Returns the [start, end) datetimes of a period given as dates like `2024-01-01`.
     """
-    new_file_name = f'{directory}{marketvenueid}_{pairid}_{start.replace(":", "-")}_{end.replace(":", "-")}.json'
-    with open(new_file_name, 'w', encoding='utf-8') as file:
-        file.write(data)
+    return parse_timestamp(f"{start}T00:00:00"), parse_timestamp(f"{end}T00:00:00")
 
 
-def file_exists(directory: str, marketvenueid: str, pairid: str, start: str, end: str) -> str:
+def fetch_or_load_market_data(headers: dict, url: str, directory: str, marketvenueid: str, pairid: str, start: str, end: str) -> tuple[dict, dict]:
     """
-    Checks if a file with the specified parameters exists.
-    Returns the path to the file if found, otherwise returns None.
+    Loads market data from the local store, fetching from the API only the hours that were never fetched before.
+    Returns memory mapped columns of the range and their schema.
     """
-    pattern = f"{directory}/{marketvenueid}_{pairid}_{start.replace(':', '-')}_{end.replace(':', '-')}.json"
-    matching_files = glob.glob(pattern)
-    return matching_files[0] if matching_files else None
-
-
-def fetch_or_load_market_data(querystring: dict, headers: dict, url: str, directory: str, marketvenueid: str, pairid: str, start: str, end: str) -> dict:
-    """
-    Tries to load market data from a file if it is already saved.
-    Otherwise, makes an API request and saves the data.
-    """
-    existing_file = file_exists(directory, marketvenueid, pairid, start, end)
-    if existing_file:
-        print(f"Loading data from existing file: {existing_file}")
-        with open(existing_file, 'r', encoding='utf-8') as file:
-            return json.load(file)
-    else:
-        response = requests.get(url, headers=headers, params=querystring)
-        response.raise_for_status()
-        data = response.json()
-        save_data(json.dumps(data), directory, marketvenueid, pairid, start, end)
-        return data
+    store = MarketStore(directory, marketvenueid, pairid)
+    range_start, range_end = period_range(start, end)
+    for missing_start, missing_end in store.missing(range_start, range_end):
+        print(f"Fetching data from {missing_start} to {missing_end}")
+        columns, schema = fetch_market_data(headers, marketvenueid, pairid, missing_start, missing_end, url)
+        store.add(columns, schema, missing_start, missing_end)
+    return store.columns(range_start, range_end), store.meta["schema"]
 
 
 def post_comment_to_issue(github_token, issue_number, repo_name, comment):
@@ -128,65 +146,95 @@ def post_comment_to_issue(github_token, issue_number, repo_name, comment):
 
 def create_prompt(article_example: str, data: dict, human_prompt_content: str) -> str:
     """
-    Creates a prompt string using article example and data.
+    Creates a prompt string using article example and data summary.
     """
     return f"<example> {article_example} </example>\n{human_prompt_content}\n<data> {json.dumps(data)} </data>"
 
 
+def report_dir(marketvenueid: str, pairid: str, start: str, end: str) -> str:
+    return os.path.join(OUTPUT_DIR, f"{start}-{end}-{marketvenueid}-{pairid}")
+
+
+def load_prompts() -> dict:
+    """
+    Reads the system prompt, the human prompt and the article example.
+    """
+    return {
+        "system": read_file(SYSTEM_PROMPT_FILE),
+        "human": read_file(HUMAN_PROMPT_FILE),
+        "example": read_file(ARTICLE_EXAMPLE_FILE),
+    }
+
+
+def write_article(data: dict, schema: dict, prompts: dict, marketvenueid: str, pairid: str, start: str, end: str,
+                  manifest: ReportManifest) -> Optional[str]:
+    """
+    Writes the article of a report with the LLM and saves it, or returns the saved one if its inputs didn't change.
+    Returns None if the prompt doesn't fit the model context.
+    """
+    # the article is written again only if the data, the prompts, the model or the code building the prompt changed
+    article_key = hash_key(columns_hash(data), prompts["system"], prompts["human"], prompts["example"],
+                           LLM_MODEL, LLM_TEMPERATURE, DATA_TOKENS,
+                           *(source_hash(module) for module in (tools.market_summary, tools.benford, tools.tokens,
+                                                                tools.market_store)))
+    if manifest.fresh("article", article_key):
+        print(f"Article up to date: {manifest.files('article')[0]}")
+        return read_file(manifest.files("article")[0])
+
+    encoding = get_encoding("gpt-4")
+    summary = summarize(data, schema, DATA_TOKENS)
+    print('num of data tokens: ', len(encoding.encode(json.dumps(summary))))
+
+    prompt = create_prompt(prompts["example"], summary, prompts["human"])
+    prompt_token_count = len(encoding.encode(prompt))
+    if prompt_token_count > MAX_TOKENS:
+        return None
+
+    completion = get_limiter("openai").call(
+        openai.ChatCompletion.create,
+        tokens=prompt_token_count + len(encoding.encode(prompts["system"])),
+        model=LLM_MODEL,
+        temperature=LLM_TEMPERATURE,
+        messages=[
+            {"role": "system", "content": prompts["system"]},
+            {"role": "user", "content": prompt}
+        ]
+    )
+    output = completion.choices[0].message.content
+    output = extract_between_tags("article", output)
+
+    print("This is an answer: ", output)
+    # a regenerated article replaces the one of the previous run instead of adding index-N.md
+    previous = manifest.files("article")
+    file_path = save_output(output, OUTPUT_DIR, marketvenueid, pairid, start, end, previous[0] if previous else None)
+    manifest.record("article", article_key, [file_path])
+    return output
+
+
 def main():
     args = parse_cli_args()
-
-    system_prompt = read_file(SYSTEM_PROMPT_FILE)
-    human_prompt_content = read_file(HUMAN_PROMPT_FILE)
-    article_example = read_file(ARTICLE_EXAMPLE_FILE)
+    prompts = load_prompts()
 
     marketvenueid, pairid, start, end = extract_data_from_comment(args.comment_body)
     print(f"Marketvenueid: {marketvenueid}, Pairid: {pairid}, Start: {start}, End: {end}")
-    querystring = {
-        "marketvenueid": marketvenueid,
-        "pairid": pairid,
-        "start": f"{start}T00:00:00",
-        "end": f"{end}T00:00:00",
-        "gran": "1h",
-        "sort": "asc",
-        "limit": "1000"
-    }
-    headers = {"X-RapidAPI-Key": args.rapid_api, "X-RapidAPI-Host": "cross-market-surveillance.p.rapidapi.com"}
-    url = "https://cross-market-surveillance.p.rapidapi.com/metrics/wt/market"
+    headers = {"X-RapidAPI-Key": args.rapid_api, "X-RapidAPI-Host": API_HOST}
 
     try:
-        data = fetch_or_load_market_data(querystring, headers, url, DATA_DIR, marketvenueid, pairid, start, end)
-
-        encoding = encoding_for_model("gpt-4")     
-        print('num of data tokens: ', len(encoding.encode(str(data))))
-
-        prompt = create_prompt(article_example, data, human_prompt_content)
-        prompt_token_count = len(encoding.encode(prompt))
-
-        if prompt_token_count > MAX_TOKENS:
-            error_message = "Your request is too long. It's possible that the period for the data is too broad. Please narrow it down."
-            print(error_message)
-            post_comment_to_issue(args.github_token, int(args.issue), REPO_NAME, error_message)
-        else:
-            openai.api_key = args.API_key
-            completion = openai.ChatCompletion.create(
-                model="gpt-4-0125-preview",
-                temperature=0.0,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}
-                ]
-            )
-            output = completion.choices[0].message.content
-            output = extract_between_tags("article", output)
-
-            print("This is an answer: ", output)
-            save_output(output, OUTPUT_DIR, marketvenueid, pairid, start, end)
-            vis = Visualization()
-            output_subdir = os.path.join(OUTPUT_DIR, f"{start}-{end}-{marketvenueid}-{pairid}") 
-            vis.generate_report(data, output_subdir)  
-
-            post_comment_to_issue(args.github_token, int(args.issue), REPO_NAME, output)
+        data, schema = fetch_or_load_market_data(headers, args.api_url, DATA_DIR, marketvenueid, pairid, start, end)
+        output_subdir = report_dir(marketvenueid, pairid, start, end)
+        manifest = ReportManifest(output_subdir)
+
+        openai.api_key = args.API_key
+        output = write_article(data, schema, prompts, marketvenueid, pairid, start, end, manifest)
+        if output is None:
+            print(TOO_LONG_MESSAGE)
+            post_comment_to_issue(args.github_token, int(args.issue), REPO_NAME, TOO_LONG_MESSAGE)
+            return
+
+        vis = Visualization(dpi=args.chart_dpi, fmt=args.chart_format)
+        vis.generate_report(data, output_subdir, manifest)
+
+        post_comment_to_issue(args.github_token, int(args.issue), REPO_NAME, output)
 
     except Exception as e:
         print(f"Error occurred: {e}")
@@ -0,0 +1,418 @@
+"""
+Columnar on-disk store of hourly market metrics.
+
+Every market (venue, pair) is a directory with one `.npy` file per column and a `meta.json` with the schema
+and the hour intervals already fetched from the API:
+
+    <data dir>/<venue>/<pair>/timestamp.npy             hours since the epoch, sorted
+    <data dir>/<venue>/<pair>/vwap.npy                  numbers, float64
+    <data dir>/<venue>/<pair>/market_id.npy             strings, fixed width unicode
+    <data dir>/<venue>/<pair>/first_digit_distribution.npy        lists, 2-D float64 padded with NaN
+    <data dir>/<venue>/<pair>/volume_distribution.volume.npy      lists of objects, one 2-D array per key
+
+Columns are memory mapped on read and a range query only touches the rows it returns.
+Records are packed into columns one at a time by ColumnBuilder, so API pages can be parsed as they stream in
+without keeping lists of records around.
+"""
+
+import os
+import json
+import math
+import hashlib
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+import numpy as np
+
+
+META_FILE = "meta.json"
+TIMESTAMP = "timestamp"
+EPOCH = datetime(1970, 1, 1)
+HOUR = timedelta(hours=1)
+# hours younger than this may still be published, an empty answer for them doesn't mean there is no data
+PUBLICATION_LAG = timedelta(hours=2)
+
+
+def to_hour(value: datetime) -> int:
+    return (value - EPOCH) // HOUR
+
+
+def from_hour(hour: int) -> datetime:
+    return EPOCH + int(hour) * HOUR
+
+
+def format_hour(hour: int) -> str:
+    return from_hour(hour).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def _value_type(value) -> Optional[str]:
+    """
+    Type of a scalar API value: "int", "float", "str" for numbers sent as strings, "text" for other strings.
+    """
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, str):
+        try:
+            float(value)
+            return "str"
+        except ValueError:
+            return "text"
+    return None
+
+
+def _number(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def _restore(value: float, value_type: str):
+    if math.isnan(value):
+        return None
+    if value_type == "int":
+        return int(value)
+    if value_type == "str":
+        return repr(float(value))
+    return float(value)
+
+
+def _copy_schema(schema: Optional[dict]) -> dict:
+    return {
+        field: {**spec, "columns": dict(spec["columns"])} if spec["kind"] == "table" else dict(spec)
+        for field, spec in (schema or {}).items()
+    }
+
+
+def _extend_schema(schema: dict, record: dict) -> bool:
+    """
+    Adds the fields of one record to the schema in place, returns True if the schema changed.
+    """
+    changed = False
+    for field, value in record.items():
+        if field == TIMESTAMP:
+            continue
+        if isinstance(value, list):
+            if not value:
+                continue
+            if isinstance(value[0], dict):
+                # objects may gain keys over time, the other kinds are fixed by the first record
+                columns = schema.setdefault(field, {"kind": "table", "columns": {}})["columns"]
+                for key, item in value[0].items():
+                    if key not in columns:
+                        columns[key] = _value_type(item) or "float"
+                        changed = True
+            elif field not in schema:
+                schema[field] = {"kind": "array", "type": _value_type(value[0]) or "float"}
+                changed = True
+        elif field not in schema:
+            value_type = _value_type(value)
+            if value_type == "text":
+                schema[field] = {"kind": "text"}
+            elif value_type is not None:
+                schema[field] = {"kind": "scalar", "type": value_type}
+            changed = changed or value_type is not None
+    return changed
+
+
+def infer_schema(records: list[dict], schema: Optional[dict] = None) -> dict:
+    """
+    Extends a schema with the fields of the records.
+    Fields are "scalar" numbers, "text", "array" lists of numbers or "table" lists of objects with numeric values.
+    """
+    schema = _copy_schema(schema)
+    for record in records:
+        _extend_schema(schema, record)
+    return schema
+
+
+def merge_schemas(first: dict, second: dict) -> dict:
+    """
+    Union of two schemas, the kind of a field is taken from the first one that has it.
+    """
+    schema = _copy_schema(first)
+    for field, spec in second.items():
+        if field not in schema:
+            schema[field] = _copy_schema({field: spec})[field]
+        elif spec["kind"] == "table" and schema[field]["kind"] == "table":
+            for key, value_type in spec["columns"].items():
+                schema[field]["columns"].setdefault(key, value_type)
+    return schema
+
+
+def _parse(value: str) -> datetime:
+    return datetime.fromisoformat(value[:19])
+
+
+class ColumnBuilder:
+    def __init__(self, schema: Optional[dict] = None, capacity: int = 1024, infer: bool = True):
+        """
+        :param schema: Fields to pack, extended with the fields of the records if `infer` is set.
+        :param capacity: Rows to preallocate, the arrays double when they fill up.
+        :param infer: Whether fields missing from the schema are added or ignored.
+        """
+        self.schema = _copy_schema(schema)
+        self.infer = infer
+        self.size = 0
+        self.capacity = max(capacity, 1)
+        self.timestamps = np.empty(self.capacity, dtype=np.int64)
+        self.numbers: dict[str, np.ndarray] = {}
+        self.texts: dict[str, list[str]] = {}
+        self._allocate()
+
+    def _allocate(self) -> None:
+        for field, spec in self.schema.items():
+            if spec["kind"] == "scalar" and field not in self.numbers:
+                self.numbers[field] = np.full(self.capacity, np.nan)
+            elif spec["kind"] == "text" and field not in self.texts:
+                self.texts[field] = [""] * self.size
+            elif spec["kind"] == "array" and field not in self.numbers:
+                self.numbers[field] = np.full((self.capacity, 0), np.nan)
+            elif spec["kind"] == "table":
+                for key in spec["columns"]:
+                    self.numbers.setdefault(f"{field}.{key}", np.full((self.capacity, 0), np.nan))
+
+    def _grow(self) -> None:
+        self.capacity *= 2
+        self.timestamps = np.resize(self.timestamps, self.capacity)
+        for name, array in self.numbers.items():
+            grown = np.full((self.capacity,) + array.shape[1:], np.nan)
+            grown[:self.size] = array[:self.size]
+            self.numbers[name] = grown
+
+    def _row(self, name: str, width: int) -> np.ndarray:
+        array = self.numbers[name]
+        if array.shape[1] < width:
+            array = self.numbers[name] = _pad(array, width)
+        return array[self.size]
+
+    def append(self, record: dict) -> None:
+        """
+        Packs one API record into the next row.
+        """
+        if self.infer and _extend_schema(self.schema, record):
+            self._allocate()
+        if self.size == self.capacity:
+            self._grow()
+        self.timestamps[self.size] = to_hour(_parse(record[TIMESTAMP]))
+        for field, spec in self.schema.items():
+            value = record.get(field)
+            kind = spec["kind"]
+            if kind == "text":
+                self.texts[field].append("" if value is None else str(value))
+            elif value is None:
+                continue
+            elif kind == "scalar":
+                self.numbers[field][self.size] = _number(value)
+            elif kind == "array" and isinstance(value, list) and value:
+                self._row(field, len(value))[:len(value)] = [_number(x) for x in value]
+            elif kind == "table" and isinstance(value, list) and value:
+                for key in spec["columns"]:
+                    self._row(f"{field}.{key}", len(value))[:len(value)] = [
+                        _number(item.get(key)) if isinstance(item, dict) else math.nan for item in value
+                    ]
+        self.size += 1
+
+    def extend(self, records) -> None:
+        for record in records:
+            self.append(record)
+
+    def finish(self) -> dict[str, np.ndarray]:
+        """
+        Returns the packed columns, trimmed to the rows appended.
+        """
+        columns = {TIMESTAMP: self.timestamps[:self.size].copy()}
+        for name, array in self.numbers.items():
+            columns[name] = array[:self.size].copy()
+        for name, values in self.texts.items():
+            columns[name] = np.array(values, dtype=str)
+        return columns
+
+
+def to_columns(records: list[dict], schema: dict) -> dict[str, np.ndarray]:
+    """
+    Packs records into column arrays following the schema.
+    """
+    builder = ColumnBuilder(schema, capacity=len(records), infer=False)
+    builder.extend(records)
+    return builder.finish()
+
+
+def columns_hash(columns: dict[str, np.ndarray]) -> str:
+    """
+    Hash of the names, shapes and contents of columns.
+    """
+    digest = hashlib.sha256()
+    for name in sorted(columns):
+        array = np.ascontiguousarray(columns[name])
+        digest.update(f"{name}:{array.dtype.str}:{array.shape}".encode("utf-8"))
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def _filler(like: np.ndarray, n: int) -> np.ndarray:
+    if like.dtype.kind == "U":
+        return np.full(n, "", dtype=like.dtype)
+    return np.full((n,) + like.shape[1:], np.nan)
+
+
+def _pad(array: np.ndarray, width: int) -> np.ndarray:
+    if array.ndim < 2 or array.shape[1] >= width:
+        return array
+    return np.concatenate([array, np.full((array.shape[0], width - array.shape[1]), np.nan)], axis=1)
+
+
+def concat_columns(first: dict[str, np.ndarray], second: dict[str, np.ndarray]) -> dict[str, np.ndarray]:
+    """
+    Concatenates two column sets row-wise, filling columns missing on either side and padding list widths.
+    """
+    n1, n2 = len(first[TIMESTAMP]), len(second[TIMESTAMP])
+    result = {}
+    for name in first.keys() | second.keys():
+        a = first.get(name)
+        b = second.get(name)
+        a = _filler(b, n1) if a is None else a
+        b = _filler(a, n2) if b is None else b
+        if a.ndim == 2:
+            width = max(a.shape[1], b.shape[1])
+            a, b = _pad(a, width), _pad(b, width)
+        result[name] = np.concatenate([a, b])
+    return result
+
+
+def merge_intervals(intervals: list[list[int]]) -> list[list[int]]:
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class MarketStore:
+    def __init__(self, directory: str, marketvenueid: str, pairid: str):
+        """
+        :param directory: Root of the store.
+        :param marketvenueid: Venue of the market, e.g. `binance`.
+        :param pairid: Pair of the market, e.g. `doge-usdt`.
+        """
+        self.path = os.path.join(directory, marketvenueid, pairid)
+        self.meta = {"schema": {}, "coverage": []}
+        try:
+            with open(os.path.join(self.path, META_FILE), "r", encoding="utf-8") as file:
+                self.meta = json.load(file)
+        except (OSError, ValueError):
+            pass
+
+    def missing(self, start: datetime, end: datetime) -> list[tuple[datetime, datetime]]:
+        """
+        Returns the [from, to) intervals of the range that were never fetched.
+        """
+        missing = []
+        cursor, end_hour = to_hour(start), to_hour(end)
+        for covered_start, covered_end in self.meta["coverage"]:
+            if covered_end <= cursor:
+                continue
+            if covered_start >= end_hour:
+                break
+            if covered_start > cursor:
+                missing.append((from_hour(cursor), from_hour(covered_start)))
+            cursor = max(cursor, covered_end)
+        if cursor < end_hour:
+            missing.append((from_hour(cursor), from_hour(end_hour)))
+        return missing
+
+    def _load(self, name: str, mmap: bool = True) -> np.ndarray:
+        return np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r" if mmap else None)
+
+    def _names(self) -> list[str]:
+        names = [TIMESTAMP]
+        for field, spec in self.meta["schema"].items():
+            if spec["kind"] == "table":
+                names += [f"{field}.{key}" for key in spec["columns"]]
+            else:
+                names.append(field)
+        return names
+
+    def _stored(self) -> bool:
+        return os.path.exists(os.path.join(self.path, f"{TIMESTAMP}.npy"))
+
+    def add(self, columns: dict[str, np.ndarray], schema: dict, start: datetime, end: datetime,
+            now: Optional[datetime] = None) -> None:
+        """
+        Stores the columns fetched for [start, end), replacing stored rows of that range.
+
+        The range is recorded as fetched up to the last returned hour, or up to `now - PUBLICATION_LAG`
+        (UTC, defaults to the current time) if that is later. Hours after it are fetched again by the next run.
+        """
+        now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+        hours = columns[TIMESTAMP]
+        published = to_hour(now - PUBLICATION_LAG)
+        covered_end = min(to_hour(end), max(int(hours.max()) + 1 if len(hours) else published, published))
+        schema = merge_schemas(self.meta["schema"], schema)
+        new = columns
+        if self._stored():
+            old = {name: self._load(name, mmap=False) for name in self._names()}
+            keep = (old[TIMESTAMP] < to_hour(start)) | (old[TIMESTAMP] >= to_hour(end))
+            new = concat_columns({name: array[keep] for name, array in old.items()}, new)
+        order = np.argsort(new[TIMESTAMP], kind="stable")
+
+        os.makedirs(self.path, exist_ok=True)
+        for name, array in new.items():
+            tmp_path = os.path.join(self.path, f"{name}.{os.getpid()}.tmp.npy")
+            np.save(tmp_path, array[order])
+            os.replace(tmp_path, os.path.join(self.path, f"{name}.npy"))
+
+        # meta is written last, a crash before leaves the old coverage and the range is fetched again
+        coverage = self.meta["coverage"] + ([[to_hour(start), covered_end]] if covered_end > to_hour(start) else [])
+        self.meta = {"schema": schema, "coverage": merge_intervals(coverage)}
+        tmp_path = os.path.join(self.path, f"{META_FILE}.{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(self.meta, file)
+        os.replace(tmp_path, os.path.join(self.path, META_FILE))
+
+    def columns(self, start: datetime, end: datetime) -> dict[str, np.ndarray]:
+        """
+        Returns memory mapped column slices of the rows in [start, end).
+        """
+        if not self._stored():
+            return {}
+        timestamps = self._load(TIMESTAMP)
+        i, j = np.searchsorted(timestamps, [to_hour(start), to_hour(end)])
+        return {name: self._load(name)[i:j] for name in self._names()}
+
+    def records(self, start: datetime, end: datetime) -> list[dict]:
+        """
+        Returns the rows in [start, end) as records shaped like the API response.
+        """
+        columns = self.columns(start, end)
+        if not columns:
+            return []
+        schema = self.meta["schema"]
+        records = [{TIMESTAMP: format_hour(hour)} for hour in columns[TIMESTAMP]]
+        for field, spec in schema.items():
+            if spec["kind"] == "scalar":
+                for record, value in zip(records, columns[field].tolist()):
+                    record[field] = _restore(value, spec["type"])
+            elif spec["kind"] == "text":
+                for record, value in zip(records, columns[field].tolist()):
+                    record[field] = value
+            elif spec["kind"] == "array":
+                for record, row in zip(records, columns[field].tolist()):
+                    record[field] = [_restore(x, spec["type"]) for x in row if not math.isnan(x)]
+            elif spec["kind"] == "table":
+                keys = list(spec["columns"])
+                first = np.asarray(columns[f"{field}.{keys[0]}"])
+                lengths = (~np.isnan(first)).sum(axis=1) if first.ndim == 2 else np.zeros(len(records), dtype=int)
+                tables = [
+                    [[_restore(x, spec["columns"][key]) for x in row[:length]]
+                     for row, length in zip(columns[f"{field}.{key}"].tolist(), lengths)]
+                    for key in keys
+                ]
+                for n, record in enumerate(records):
+                    record[field] = [dict(zip(keys, values)) for values in zip(*(table[n] for table in tables))]
+        return records
@@ -0,0 +1,236 @@
+"""
+Condenses hourly market metrics into a compact summary that fits a token budget.
+
+The summary has the overall statistics of every metric, per-day statistics, downsampled series,
+hours where a metric deviates strongly from its median and, for bucketed distributions like
+`volume_distribution`, weighted quantiles instead of the buckets.
+Series resolution is reduced until the serialized summary fits the budget.
+"""
+
+import json
+import numpy as np
+
+from tools.market_store import TIMESTAMP, from_hour
+from tools.benford import DIGIT_FIELDS, benford_tests, volume_concentration, mad_conformity
+from tools.tokens import count_tokens
+
+
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9, 0.99)
+SERIES_QUANTILES = (0.5, 0.9, 0.99)
+ANOMALY_Z = 5.0
+# series lengths tried from the most to the least detailed
+RESOLUTIONS = (None, 1000, 500, 250, 120, 60, 30, 15)
+
+FORMAT = (
+    "`stats` has overall statistics of each metric, `daily` per-day mean/min/max, "
+    "`series` metric values averaged over consecutive intervals starting at `series.timestamps`, "
+    "`distributions` the totals of list metrics over the period, "
+    "`quantiles` weighted quantiles of bucketed distributions (pN is the N-th percentile), "
+    "`benford` chi-square, Kolmogorov-Smirnov and mean absolute deviation tests of the period's first digits "
+    "against Benford's law at 5% significance (hourly values are in the `benford_*` metrics), "
+    "`*_hhi`, `*_top_bucket_share`, `*_gini` and `*_tail_volume_share` metrics measure how trades concentrate in volume buckets, "
+    "`anomalies` hours where a metric deviates from its median by more than "
+    f"{ANOMALY_Z:g} robust standard deviations (z)."
+)
+
+
+def _round(value) -> float:
+    return float(f"{value:.4g}") if np.isfinite(value) else None
+
+
+def _rounded(values: np.ndarray) -> list:
+    return [_round(x) for x in values.tolist()]
+
+
+def _format_hour(hour: int, daily: bool = False) -> str:
+    return from_hour(hour).strftime("%Y-%m-%d" if daily else "%Y-%m-%d %H:00")
+
+
+def weighted_quantiles(values: np.ndarray, weights: np.ndarray, quantiles=QUANTILES) -> np.ndarray:
+    """
+    Weighted quantiles of each row of a 2-D array of bucket values. Returns an array of shape (rows, quantiles).
+    """
+    values = np.where(np.isnan(values), np.inf, values)
+    weights = np.nan_to_num(weights)
+    order = np.argsort(values, axis=1)
+    values = np.take_along_axis(values, order, axis=1)
+    cumulative = np.cumsum(np.take_along_axis(weights, order, axis=1), axis=1)
+    totals = cumulative[:, -1:]
+    result = np.full((len(values), len(quantiles)), np.nan)
+    for i, q in enumerate(quantiles):
+        index = np.argmax(cumulative >= q * totals, axis=1)
+        result[:, i] = values[np.arange(len(values)), index]
+    result[totals[:, 0] == 0] = np.nan
+    return result
+
+
+def table_keys(spec: dict) -> tuple[str, str]:
+    """
+    Returns the (value key, weight key) of a bucketed distribution, the weight key is `count` if there is one.
+    """
+    keys = list(spec["columns"])
+    weight = "count" if "count" in keys else keys[-1]
+    value = next(key for key in keys if key != weight)
+    return value, weight
+
+
+def metric_columns(columns: dict[str, np.ndarray], schema: dict) -> tuple[np.ndarray, dict[str, np.ndarray], dict[str, np.ndarray], dict]:
+    """
+    Splits store columns into hour timestamps, scalar metric series, list metrics and bucket quantile tables.
+    Quantiles and concentration of bucketed distributions are added to the scalar series as `<metric>_pN`
+    and `<metric>_<measure>`, Benford's law tests of first digit counts as `benford_<statistic>`.
+    """
+    scalars, arrays, quantiles = {}, {}, {}
+    for field, spec in schema.items():
+        if spec["kind"] == "scalar":
+            scalars[field] = np.asarray(columns[field])
+        elif spec["kind"] == "array":
+            arrays[field] = np.asarray(columns[field])
+            if field in DIGIT_FIELDS:
+                tests = benford_tests(columns[field])
+                for name in ("chi2", "mad", "ks", "ks_critical"):
+                    scalars[f"benford_{name}"] = tests[name]
+        elif spec["kind"] == "table" and len(spec["columns"]) >= 2:
+            value, weight = table_keys(spec)
+            values, weights = np.asarray(columns[f"{field}.{value}"]), np.asarray(columns[f"{field}.{weight}"])
+            if values.shape[1] == 0:
+                continue
+            quantiles[field] = {
+                "values": values,
+                "weights": weights,
+                "per_hour": weighted_quantiles(values, weights, SERIES_QUANTILES),
+            }
+            for i, q in enumerate(SERIES_QUANTILES):
+                scalars[f"{field}_p{round(q * 100)}"] = quantiles[field]["per_hour"][:, i]
+            for name, values in volume_concentration(values, weights).items():
+                scalars[f"{field}_{name}"] = values
+    return np.asarray(columns[TIMESTAMP]), scalars, arrays, quantiles
+
+
+def robust_anomalies(hours: np.ndarray, scalars: dict[str, np.ndarray], limit: int) -> list[dict]:
+    """
+    Finds the hours where a metric is more than ANOMALY_Z median absolute deviations away from its median.
+    """
+    found = []
+    for name, values in scalars.items():
+        if not np.isfinite(values).any():
+            continue
+        median = np.nanmedian(values)
+        mad = 1.4826 * np.nanmedian(np.abs(values - median))
+        if not mad:
+            continue
+        z = (values - median) / mad
+        for i in np.flatnonzero(np.abs(np.nan_to_num(z)) > ANOMALY_Z):
+            found.append({
+                "timestamp": _format_hour(hours[i]),
+                "metric": name,
+                "value": _round(values[i]),
+                "median": _round(median),
+                "z": _round(z[i]),
+            })
+    found.sort(key=lambda x: abs(x["z"]), reverse=True)
+    return found[:limit]
+
+
+def downsample_mean(hours: np.ndarray, values: np.ndarray, points: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Averages consecutive hours into at most `points` buckets, returns bucket start hours and means.
+    """
+    if points is None or len(values) <= points:
+        return hours, values
+    bounds = np.linspace(0, len(values), points + 1).astype(int)
+    starts = bounds[:-1]
+    sums = np.add.reduceat(np.nan_to_num(values), starts)
+    counts = np.add.reduceat(np.isfinite(values).astype(int), starts)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return hours[starts], np.where(counts > 0, sums / counts, np.nan)
+
+
+def daily_stats(hours: np.ndarray, scalars: dict[str, np.ndarray]) -> dict:
+    days, index = np.unique(hours // 24, return_inverse=True)
+    result = {"days": [_format_hour(day * 24, daily=True) for day in days]}
+    for name, values in scalars.items():
+        finite = np.isfinite(values)
+        counts = np.bincount(index, weights=finite, minlength=len(days))
+        sums = np.bincount(index, weights=np.where(finite, values, 0), minlength=len(days))
+        minimum = np.full(len(days), np.inf)
+        maximum = np.full(len(days), -np.inf)
+        np.minimum.at(minimum, index[finite], values[finite])
+        np.maximum.at(maximum, index[finite], values[finite])
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result[name] = {
+                "mean": _rounded(np.where(counts > 0, sums / counts, np.nan)),
+                "min": _rounded(np.where(counts > 0, minimum, np.nan)),
+                "max": _rounded(np.where(counts > 0, maximum, np.nan)),
+            }
+    return result
+
+
+def period_benford(digits: np.ndarray) -> dict:
+    """
+    Benford's law tests of the first digit counts of the whole period.
+    """
+    tests = benford_tests(digits)
+    return {
+        "chi2": _round(tests["chi2"][0]), "chi2_critical": _round(tests["chi2_critical"][0]),
+        "ks": _round(tests["ks"][0]), "ks_critical": _round(tests["ks_critical"][0]),
+        "mad": _round(tests["mad"][0]), "mad_conformity": mad_conformity(tests["mad"])[0],
+        "conforms": not bool(tests["rejected"][0]),
+    }
+
+
+def summarize(columns: dict[str, np.ndarray], schema: dict, max_tokens: int, model: str = "gpt-4") -> dict:
+    """
+    Builds the most detailed summary of the columns whose JSON fits in `max_tokens`, or the coarsest one if none fits.
+    """
+    if not len(columns.get(TIMESTAMP, ())):
+        return {"format": FORMAT, "period": None}
+    hours, scalars, arrays, quantiles = metric_columns(columns, schema)
+    span = int(hours[-1] - hours[0]) + 1
+
+    base = {
+        "format": FORMAT,
+        "period": {
+            "start": _format_hour(hours[0]),
+            "end": _format_hour(hours[-1]),
+            "hours_with_data": len(hours),
+            "hours_missing": span - len(hours),
+        },
+        "stats": {
+            name: {
+                "mean": _round(np.nanmean(values)), "std": _round(np.nanstd(values)),
+                "min": _round(np.nanmin(values)), "median": _round(np.nanmedian(values)),
+                "max": _round(np.nanmax(values)),
+            }
+            for name, values in scalars.items() if np.isfinite(values).any()
+        },
+        "distributions": {name: _rounded(np.nansum(values, axis=0)) for name, values in arrays.items()},
+        "benford": {
+            name: period_benford(np.nansum(values, axis=0))
+            for name, values in arrays.items() if name in DIGIT_FIELDS
+        },
+        "quantiles": {
+            name: dict(zip(
+                (f"p{round(q * 100)}" for q in QUANTILES),
+                _rounded(weighted_quantiles(table["values"].reshape(1, -1), table["weights"].reshape(1, -1))[0]),
+            ))
+            for name, table in quantiles.items()
+        },
+    }
+    daily = daily_stats(hours, scalars) if span > 24 else None
+
+    summary = None
+    for points in RESOLUTIONS:
+        if points is not None and points >= len(hours):
+            continue
+        series_hours, _ = downsample_mean(hours, hours.astype(float), points)
+        series = {"timestamps": [_format_hour(hour) for hour in series_hours]}
+        for name, values in scalars.items():
+            series[name] = _rounded(downsample_mean(hours, values, points)[1])
+        anomalies = robust_anomalies(hours, scalars, 50 if points is None or points >= 250 else 20)
+        # per-day statistics are only worth their tokens while the series are finer than days
+        for with_daily in (True, False) if daily is not None and (points is None or points * 24 >= span) else (False,):
+            summary = {**base, **({"daily": daily} if with_daily else {}), "series": series, "anomalies": anomalies}
+            if count_tokens(json.dumps(summary), model) <= max_tokens:
+                return summary
+    return summary
@@ -0,0 +1,117 @@
+"""
+Word shingling, MinHash signatures and LSH banding for near-duplicate search over article texts.
+"""
+
+import re
+import zlib
+from collections import defaultdict
+import numpy as np
+
+
+NUM_PERM = 128
+# 64 bands of 2 rows: pairs with Jaccard ~0.1 become candidates about half of the time, ~0.2 almost always
+BANDS = 64
+SHINGLE_SIZE = 2
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> np.ndarray:
+    """
+    Returns the unique 32-bit hashes of the word n-grams of a text.
+    """
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < size:
+        grams = [" ".join(words)] if words else []
+    else:
+        grams = [" ".join(words[i:i + size]) for i in range(len(words) - size + 1)]
+    return np.unique(np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams)))
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = NUM_PERM, shingle_size: int = SHINGLE_SIZE, seed: int = 1):
+        """
+        :param num_perm: Number of hash permutations, i.e. the signature length.
+        :param shingle_size: Number of words per shingle.
+        :param seed: Seed of the permutations, signatures are only comparable for the same seed.
+        """
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.a = rng.randint(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        """
+        Computes the MinHash signature of a text. Texts without shingles get the all-max signature, see is_empty().
+        """
+        hashes = shingles(text, self.shingle_size)
+        if not len(hashes):
+            return np.full(self.num_perm, _MAX_HASH, dtype=np.uint64)
+        # uint64 products wrap around, which is fine for hashing purposes
+        permuted = ((np.outer(hashes, self.a) + self.b) % _MERSENNE_PRIME) & _MAX_HASH
+        return permuted.min(axis=0)
+
+
+def is_empty(signature: np.ndarray) -> bool:
+    """
+    Tells if the signature is the one of a text without shingles.
+    """
+    return bool(np.all(signature == _MAX_HASH))
+
+
+def jaccard(signature1: np.ndarray, signature2: np.ndarray) -> float:
+    """
+    Estimates the Jaccard similarity of two texts from their signatures, texts without shingles are similar to none.
+    """
+    if is_empty(signature1) or is_empty(signature2):
+        return 0.0
+    return float(np.mean(signature1 == signature2))
+
+
+class LSHIndex:
+    def __init__(self, num_perm: int = NUM_PERM, bands: int = BANDS):
+        """
+        :param num_perm: Signature length, must be divisible by `bands`.
+        :param bands: Number of LSH bands.
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.buckets = [defaultdict(set) for _ in range(bands)]
+        self.signatures = {}
+
+    def _band_keys(self, signature: np.ndarray):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def add(self, key: str, signature: np.ndarray) -> None:
+        """
+        Indexes a signature, signatures of texts without shingles are skipped.
+        """
+        if is_empty(signature):
+            return
+        self.signatures[key] = signature
+        for band, band_key in self._band_keys(signature):
+            self.buckets[band][band_key].add(key)
+
+    def candidates(self, signature: np.ndarray) -> set[str]:
+        """
+        Returns keys sharing at least one band with the signature.
+        """
+        found = set()
+        if is_empty(signature):
+            return found
+        for band, band_key in self._band_keys(signature):
+            found |= self.buckets[band].get(band_key, set())
+        return found
+
+    def query(self, signature: np.ndarray, extra_keys=()) -> list[tuple[str, float]]:
+        """
+        Returns LSH candidates and `extra_keys` ranked by estimated Jaccard similarity.
+        """
+        keys = self.candidates(signature) | {key for key in extra_keys if key in self.signatures}
+        ranked = [(key, jaccard(signature, self.signatures[key])) for key in keys]
+        return sorted(ranked, key=lambda x: x[1], reverse=True)
@@ -8,7 +8,8 @@ import os, argparse
 import yaml
 from github import Github, GithubException
 from tools.utils import logging_decorator
-from tools.git import get_pull_request, get_diff_by_url, parse_diff
+from tools.git import get_pull_request, get_diff, parse_diff, DIFF_SOURCES, Hunk
+from typing import Iterable
 
 data = {}
 
@@ -33,6 +34,9 @@ def parse_cli_args():
     parser.add_argument(
         "-f", "--fixed", dest="fixed", help="Fixed payout value", type=float, required=False
     )
+    parser.add_argument(
+        "--diff-source", dest="diff_source", help="Where to get the PR diff from", choices=DIFF_SOURCES, default="url"
+    )
     return parser.parse_args()
 
 args = parse_cli_args()
@@ -69,7 +73,7 @@ def load_config() -> dict:
 config = load_config()
 
 
-def count_chars(diff: list[dict]) -> int:
+def count_chars(diff: Iterable[Hunk]) -> int:
     """
     Count characters in a Github PR diff.
     Returns the number of characters.
@@ -77,16 +81,14 @@ def count_chars(diff: list[dict]) -> int:
 
     chars = 0
 
-    for file in diff:
-        for segments in file["body"]:
-            for line in segments["body"].splitlines():
-                # only count line additions
-                if line.startswith("+"):
-                    # sanitize line
-                    line = line[2:]  # rm addition indicator
-                    line = line.strip()  # rm leading/trailing whitespace
-                    # line = line.replace(" ", "") # rm all whitespace
-                    chars += len(line)
+    for hunk in diff:
+        # only count line additions
+        for line in hunk.added:
+            # sanitize line
+            text = line.text[1:]  # same offset as the former line[2:] on raw "+" lines
+            text = text.strip()  # rm leading/trailing whitespace
+            # text = text.replace(" ", "") # rm all whitespace
+            chars += len(text)
 
     return chars
 
@@ -129,7 +131,7 @@ def main():
     pr = get_pull_request(github, args.pull_url)
 
     # TODO: Improve Diff method. Get diff by words instead of lines.
-    _diff = get_diff_by_url(pr)
+    _diff = get_diff(pr, args.diff_source)
     diff = parse_diff(_diff)
     data["chars"] = count_chars(diff)
     data["value"] = calc_payout(chars=data["chars"], rate=config["rate"], multiplier=config["multiplier"], fixed=args.fixed)
@@ -0,0 +1,187 @@
+"""
+Client-side rate limiting and retries shared by all LLM calls of the bots.
+
+Every API has one process-wide limiter with token buckets for requests and tokens per minute.
+Failed calls are retried only if the error can go away (rate limits, timeouts, server errors),
+after the delay from the Retry-After header or a jittered exponential backoff.
+A rate limit response pauses all callers of the limiter, not just the one that got it.
+"""
+
+import time
+import random
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Optional
+
+
+# Requests and tokens per minute, kept below the account limits to leave room for other jobs
+LIMITS = {
+    "openai": {"requests_per_minute": 500, "tokens_per_minute": 80_000},
+    "anthropic": {"requests_per_minute": 50, "tokens_per_minute": 40_000},
+}
+
+RETRYABLE_STATUSES = {408, 409, 429}
+RETRYABLE_ERRORS = {
+    "APIConnectionError", "APITimeoutError", "Timeout", "TryAgain", "ServiceUnavailableError",
+    "ConnectionError", "ConnectTimeout", "ReadTimeout", "ClientConnectionError", "ServerDisconnectedError",
+}
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Rough token count for rate limiting, about four characters per token for English text.
+    """
+    return len(text) // 4 + 1
+
+
+def status_code(error: Exception) -> Optional[int]:
+    """
+    Returns the HTTP status of an API error raised by openai, anthropic or requests, if there is one.
+    """
+    for attr in ("http_status", "status_code", "status"):
+        status = getattr(error, attr, None)
+        if isinstance(status, int):
+            return status
+    status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Tells if a failed call can succeed when repeated. Invalid requests and authentication errors never do.
+    """
+    status = status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUSES or status >= 500
+    if isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return True
+    return any(cls.__name__ in RETRYABLE_ERRORS for cls in type(error).__mro__)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """
+    Returns the delay in seconds requested by the Retry-After header of an API error.
+    """
+    headers = getattr(error, "headers", None) or getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        """
+        :param per_minute: Refill rate, also the bucket capacity.
+        """
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """
+        Takes `amount` from the bucket and returns how many seconds the caller has to wait before using it.
+        The level can go below zero, later callers then wait for the debt to be refilled.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+            self.level -= min(amount, self.capacity)
+            return max(-self.level / self.rate, 0.0)
+
+
+class RateLimiter:
+    def __init__(self, name: str, requests_per_minute: float, tokens_per_minute: Optional[float] = None,
+                 max_retries: int = 3, base_delay: float = 2.0, max_delay: float = 60.0):
+        """
+        :param name: API name used in log messages.
+        :param requests_per_minute: Limit of started requests.
+        :param tokens_per_minute: Limit of estimated prompt and completion tokens, None for no limit.
+        :param max_retries: Default number of retries of a failed call.
+        :param base_delay: First backoff delay in seconds, doubled on every retry.
+        :param max_delay: Upper bound of a single backoff delay.
+        """
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: int) -> float:
+        wait = self.requests.reserve(1)
+        if self.tokens is not None and tokens:
+            wait = max(wait, self.tokens.reserve(tokens))
+        with self._lock:
+            return max(wait, self._paused_until - time.monotonic())
+
+    def _delay(self, error: Exception, attempt: int) -> float:
+        delay = retry_after(error)
+        if delay is None:
+            delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+        if status_code(error) == 429:
+            with self._lock:
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        print(f"{self.name}: {error}. Retry {attempt + 1} in {delay:.1f} seconds")
+        return delay
+
+    def call(self, func: Callable, *args, tokens: int = 0, retries: Optional[int] = None, **kwargs) -> Any:
+        """
+        Calls `func(*args, **kwargs)` within the limits and retries it on retryable errors.
+
+        :param tokens: Estimated tokens of the request and response.
+        :param retries: Number of retries, defaults to `max_retries`.
+        """
+        retries = self.max_retries if retries is None else retries
+        for attempt in range(retries + 1):
+            time.sleep(self._reserve(tokens))
+            try:
+                return func(*args, **kwargs)
+            except Exception as ex:
+                if attempt == retries or not is_retryable(ex):
+                    raise
+                time.sleep(self._delay(ex, attempt))
+
+    async def acall(self, func: Callable, *args, tokens: int = 0, retries: Optional[int] = None, **kwargs) -> Any:
+        """
+        Same as call() for a coroutine function, waits without blocking the event loop.
+        """
+        retries = self.max_retries if retries is None else retries
+        for attempt in range(retries + 1):
+            await asyncio.sleep(self._reserve(tokens))
+            try:
+                return await func(*args, **kwargs)
+            except Exception as ex:
+                if attempt == retries or not is_retryable(ex):
+                    raise
+                await asyncio.sleep(self._delay(ex, attempt))
+
+
+_limiters: dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name: str) -> RateLimiter:
+    """
+    Returns the process-wide limiter of an API listed in `LIMITS`.
+    """
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = RateLimiter(name, **LIMITS[name])
+        return _limiters[name]
@@ -1,92 +1,263 @@
-import matplotlib.pyplot as plt
+"""
+Charts of the market health report.
+
+Figures are built with the object-oriented matplotlib API on Agg canvases, so no GUI backend or pyplot state is
+involved and every chart can be rendered in its own process.
+Time series are downsampled to about one point per pixel with Largest-Triangle-Three-Buckets, which keeps peaks
+and the shape of the line, so charts of a year take as long to draw as charts of a week.
+"""
+
+import os
+import sys
+import hashlib
+from typing import Optional
+from concurrent.futures import Executor, ProcessPoolExecutor
 import pandas as pd
 import numpy as np
+import matplotlib
 import matplotlib.dates as mdates
-import os
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from tools.benford import DIGIT_FIELDS, benford_tests, ks_critical_value
+from tools.cache import hash_key
+from tools.market_store import TIMESTAMP
+from tools.report_manifest import ReportManifest, source_hash
+
+
+DPI = 100
+FORMAT = "png"
+# markers are only drawn on series short enough for them to be told apart
+MAX_MARKERS = 500
+# points per line, about the width of the plot area in pixels at the default dpi
+MAX_POINTS = 1500
+
+
+def _figure(**kwargs) -> Figure:
+    fig = Figure(**kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def lttb(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets downsampling, returns the indices of the `points` samples to keep.
+    The first and last samples are kept, from every bucket in between the one forming the largest triangle
+    with the previously kept sample and the mean of the next bucket.
+    """
+    n = len(x)
+    if points >= n or points < 3:
+        return np.arange(n)
+    bounds = np.linspace(1, n - 1, points - 1).astype(int)
+    selected = np.empty(points, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(points - 2):
+        start, end = bounds[i], bounds[i + 1]
+        next_start, next_end = (bounds[i + 1], bounds[i + 2]) if i + 2 < len(bounds) else (n - 1, n)
+        mean_x, mean_y = x[next_start:next_end].mean(), y[next_start:next_end].mean()
+        area = np.abs((x[a] - mean_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (mean_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def downsample(series: pd.Series, points: int = MAX_POINTS) -> pd.Series:
+    """
+    Drops missing values and reduces a time series to at most `points` samples with lttb().
+    """
+    series = series[np.isfinite(series.to_numpy(dtype=np.float64))]
+    if len(series) <= points:
+        return series
+    x = series.index.asi8.astype(np.float64)
+    return series.iloc[lttb(x, series.to_numpy(dtype=np.float64), points)]
+
+
+def _plot(ax, series: pd.Series, **kwargs):
+    series = downsample(series)
+    return ax.plot(series.index, series.to_numpy(), **kwargs)
+
+
+def _date_axis(ax, index: pd.DatetimeIndex):
+    """
+    Places 4-12 date ticks whatever the length of the series, with hours only on ranges of a few days.
+    """
+    span = index.max() - index.min() if len(index) else pd.Timedelta(0)
+    ax.xaxis.set_major_locator(mdates.AutoDateLocator(minticks=4, maxticks=12))
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d %H:%M' if span <= pd.Timedelta(days=3) else '%Y-%m-%d'))
+
+
+def _make_volume_hist(data):
+    fig = _figure(figsize=(10, 6))
+    ax = fig.add_subplot()
+    ax.hist(data['volume'].dropna(), bins=30, color='skyblue', edgecolor='black')
+    ax.set_xlabel('Transaction Volume')
+    ax.set_ylabel('Frequency')
+    ax.set_title('Transaction Volume Distribution')
+    ax.grid(True, which='both', linestyle='--', linewidth=0.5)
+    return fig
+
+
+def _make_crypto_metrics(data):
+    fig = _figure(figsize=(15, 10))
+    axs = fig.subplots(4, 1, sharex=True)
+
+    _plot(axs[0], data['volume'], label='Volume', color='blue')
+    axs[0].set_ylabel('Volume')
+
+    _plot(axs[1], data['tradecount'], label='Trade Count', color='green')
+    axs[1].set_ylabel('Trade Count')
+
+    _plot(axs[2], data['avgtransactionsize'], label='Avg Transaction Size', color='orange')
+    axs[2].set_ylabel('Avg Transaction Size')
+
+    _plot(axs[3], data['buysellratio'], label='Buy/Sell Ratio', color='red')
+    axs[3].set_ylabel('Buy/Sell Ratio')
+
+    axs[3].set_xlabel('Timestamp')
+    _date_axis(axs[3], data.index)
+
+    fig.suptitle('Cryptocurrency Metrics Over Time')
+
+    for ax in axs:
+        ax.tick_params(axis='x', labelrotation=45)
+        for label in ax.get_xticklabels():
+            label.set_horizontalalignment('right')
+
+    fig.tight_layout()
+    return fig
+
+
+def _make_benfordlaw(data):
+    fig = _figure(figsize=(15, 10), layout='constrained')
+    ax1 = fig.add_subplot()
+    _plot(ax1, data['benfordlawtest'], color='blue', linestyle='-', label='Benford Law Test Score')
+    ax1.set_xlabel('Timestamp')
+    ax1.set_ylabel('Benford Law Test Score', color='blue')
+    _date_axis(ax1, data.index)
+    ax2 = ax1.twinx()
+    _plot(ax2, data['benfordcritical'], color='green', linestyle='-', label='K-S Critical Value')
+    ax2.set_ylabel('K-S Critical Value', color='green')
+    ax1.set_title('Benford Law Test Score and Critical Value Over Time')
+    lines = ax1.get_lines() + ax2.get_lines()
+    labels = [line.get_label() for line in lines]
+    ax1.legend(lines, labels, loc='upper left')
+    return fig
+
+
+def _make_vvcorrelation(data):
+    fig = _figure(figsize=(15, 10), layout='constrained')
+    ax = fig.add_subplot()
+    series = downsample(data['vvcorrelation'])
+    marker = 'o' if len(series) <= MAX_MARKERS else None
+    ax.plot(series.index, series.to_numpy(), color='purple', linestyle='-', marker=marker, label='VV Correlation')
+    _date_axis(ax, data.index)
+    ax.set_xlabel('Timestamp')
+    ax.set_ylabel('VV Correlation')
+    ax.set_title('VV Correlation Over Time')
+    ax.legend()
+    ax.tick_params(axis='x', labelrotation=45)
+    return fig
+
+
+# file name, chart function and the columns it plots
+CHARTS = {
+    'volume_hist': (_make_volume_hist, ['volume']),
+    'crypto_metrics': (_make_crypto_metrics, ['volume', 'tradecount', 'avgtransactionsize', 'buysellratio']),
+    'benford_law': (_make_benfordlaw, ['benfordlawtest', 'benfordcritical']),
+    'vv_correlation': (_make_vvcorrelation, ['vvcorrelation']),
+}
+
+
+def chart_key(name: str, data: pd.DataFrame, fmt: str, dpi: int) -> str:
+    """
+    Hash of everything a chart is drawn from: its columns, the format, the dpi and the code of this module.
+    """
+    _, columns = CHARTS[name]
+    frame_hash = hashlib.sha256(pd.util.hash_pandas_object(data[columns]).to_numpy().tobytes()).hexdigest()
+    return hash_key(name, frame_hash, fmt, dpi, source_hash(sys.modules[__name__]))
+
+
+def render_chart(name: str, data: pd.DataFrame, path: str, dpi: int = DPI) -> str:
+    """
+    Draws the chart `name` of CHARTS and saves it to `path`, the format follows the file extension.
+    """
+    make, _ = CHARTS[name]
+    # long lines are drawn in chunks, Agg fails or slows down on paths with hundreds of thousands of vertices
+    with matplotlib.rc_context({'agg.path.chunksize': 10000, 'path.simplify': True}):
+        fig = make(data)
+        fig.savefig(path, dpi=dpi)
+    return path
 
 
 class Visualization:
-    def __init__(self):
-        pass
-
-
-    def _make_volume_hist(self, data, directory):
-        plt.figure(figsize=(10, 6))
-        plt.hist(data['volume'], bins=30, color='skyblue', edgecolor='black')
-        plt.xlabel('Transaction Volume')
-        plt.ylabel('Frequency')
-        plt.title('Transaction Volume Distribution')
-        plt.grid(True, which='both', linestyle='--', linewidth=0.5)
-        plt.savefig(os.path.join(directory, 'volume_hist.png'))
-        plt.close()
-
-
-    def _make_crypto_metrics(self, data, directory):
-        fig, axs = plt.subplots(4, 1, figsize=(15, 10), sharex=True)
-
-        axs[0].plot(data.index, data['volume'], label='Volume', color='blue')
-        axs[0].set_ylabel('Volume')
-
-        axs[1].plot(data.index, data['tradecount'], label='Trade Count', color='green')
-        axs[1].set_ylabel('Trade Count')
-
-        axs[2].plot(data.index, data['avgtransactionsize'], label='Avg Transaction Size', color='orange')
-        axs[2].set_ylabel('Avg Transaction Size')
-
-        axs[3].plot(data.index, data['buysellratio'], label='Buy/Sell Ratio', color='red')
-        axs[3].set_ylabel('Buy/Sell Ratio')
-
-        axs[3].set_xlabel('Timestamp')
-
-        fig.suptitle('Cryptocurrency Metrics Over Time')
-
-        for ax in axs:
-            plt.setp(ax.get_xticklabels(), rotation=45, ha='right')
-
-        plt.tight_layout()
-        plt.savefig(os.path.join(directory, 'crypto_metrics.png'))
-        plt.close()
-        
-
-    def _make_benfordlaw(self, data, directory):
-        fig, ax1 = plt.subplots(figsize=(15, 10), layout='constrained')
-        ax1.plot(data.index, data['benfordlawtest'], color='blue', linestyle='-', label='Benford Law Test Score')
-        ax1.set_xlabel('Timestamp')
-        ax1.set_ylabel('Benford Law Test Score', color='blue')
-        ax1.xaxis.set_major_locator(mdates.HourLocator(interval=24))
-        ax1.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d %H:%M'))
-        ax2 = ax1.twinx()
-        ax2.plot(data.index, 1.36 / np.sqrt(data['tradecount']), color='green', linestyle='-', label='Trade Count')
-        ax2.set_ylabel('Trade Count', color='green')
-        ax1.set_title('Benford Law Test Score and Trade Count Over Time')
-        lines = ax1.get_lines() + ax2.get_lines()
-        labels = [line.get_label() for line in lines]
-        ax1.legend(lines, labels, loc='upper left')
-        plt.savefig(os.path.join(directory, 'benford_law.png'))
-        plt.close()
-
-
-    def _make_vvcorrelation(self, data, directory):
-        fig, ax = plt.subplots(figsize=(15, 10), layout='constrained')
-        ax.plot(data.index, data['vvcorrelation'], color='purple', linestyle='-', marker='o', label='VV Correlation')
-        ax.xaxis.set_major_locator(mdates.HourLocator(interval=24))
-        ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d %H:%M'))
-        ax.set_xlabel('Timestamp')
-        ax.set_ylabel('VV Correlation')
-        ax.set_title('VV Correlation Over Time')
-        ax.legend()
-        plt.xticks(rotation=45)
-        plt.savefig(os.path.join(directory, 'vv_correlation.png'))
-        plt.close()
-
-    def generate_report(self, data, directory):
+    def __init__(self, dpi: int = DPI, fmt: str = FORMAT, workers: int = len(CHARTS)):
+        """
+        :param dpi: Resolution of the saved charts.
+        :param fmt: File format of the charts, e.g. `png` or `svg`.
+        :param workers: Processes rendering charts at once, at most one per CPU. With 1 charts are rendered in the calling process.
+        """
+        self.dpi = dpi
+        self.fmt = fmt
+        self.workers = workers
+
+
+    def _add_benford_tests(self, data, columns):
+        """
+        Computes the K-S test and its critical value from the raw first digit counts when they are in the columns.
+        """
+        digit_field = next((field for field in DIGIT_FIELDS if field in columns), None)
+        if digit_field is not None:
+            tests = benford_tests(columns[digit_field])
+            data['benfordlawtest'] = tests['ks']
+            data['tradecount'] = data['tradecount'] if 'tradecount' in data else tests['n']
+            data['benfordcritical'] = tests['ks_critical']
+        else:
+            data['benfordcritical'] = ks_critical_value(data['tradecount'].astype(float))
+
+
+    def _prepare(self, columns) -> pd.DataFrame:
+        """
+        Builds a frame of the one-dimensional columns indexed by time, lists like digit counts stay arrays.
+        """
+        index = pd.DatetimeIndex(pd.to_datetime(np.asarray(columns[TIMESTAMP]), unit='h'), name='timestamp')
+        data = pd.DataFrame(
+            {name: np.asarray(array) for name, array in columns.items() if name != TIMESTAMP and np.ndim(array) == 1},
+            index=index,
+        )
+        self._add_benford_tests(data, columns)
+        return data
+
+
+    def generate_report(self, data, directory, manifest: Optional[ReportManifest] = None,
+                        executor: Optional[Executor] = None) -> list[str]:
+        """
+        Renders all charts of the market columns (see `tools.market_store`) into `directory` and returns the chart paths.
+        With a manifest, charts whose data and parameters didn't change since the last run are not rendered again.
+        With an executor, charts are rendered in it instead of a pool of this call, so reports can share one pool.
+        """
         if not os.path.exists(directory):
             os.makedirs(directory)
-        data = pd.DataFrame(data)
-        data['timestamp'] = pd.to_datetime(data['timestamp'])
-        data.set_index('timestamp', inplace=True)
-
-        self._make_volume_hist(data, directory)
-        self._make_crypto_metrics(data, directory)
-        self._make_benfordlaw(data, directory)
-        self._make_vvcorrelation(data, directory)
\ No newline at end of file
+        data = self._prepare(data)
+
+        paths = {name: os.path.join(directory, f'{name}.{self.fmt}') for name in CHARTS}
+        keys = {name: chart_key(name, data, self.fmt, self.dpi) for name in CHARTS} if manifest else {}
+        stale = [name for name in CHARTS if manifest is None or not manifest.fresh(f'chart:{name}', keys[name])]
+        if len(stale) < len(CHARTS):
+            print(f"Charts up to date: {', '.join(name for name in CHARTS if name not in stale)}")
+
+        # each worker gets only the columns its chart plots
+        jobs = [(name, data[CHARTS[name][1]], paths[name], self.dpi) for name in stale]
+        workers = min(self.workers, len(jobs), os.cpu_count() or 1)
+        if executor is not None and jobs:
+            list(executor.map(render_chart, *zip(*jobs)))
+        elif workers <= 1:
+            for job in jobs:
+                render_chart(*job)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(render_chart, *zip(*jobs)))
+        if manifest is not None:
+            for name in stale:
+                manifest.record(f'chart:{name}', keys[name], [paths[name]])
+        return list(paths.values())
@@ -0,0 +1,66 @@
+"""
+Build manifest of a market health report directory.
+
+`.manifest.json` in the report directory maps every generated artifact (the article, each chart) to the hash of
+the inputs it was built from and the files it produced. A re-run skips the artifacts whose inputs hash the same
+and whose files still exist, and regenerates only the others.
+"""
+
+import os
+import json
+import hashlib
+from types import ModuleType
+
+
+MANIFEST_FILE = ".manifest.json"
+
+
+def source_hash(module: ModuleType) -> str:
+    """
+    Hash of a module's source file, so artifacts are rebuilt when the code that makes them changes.
+    """
+    with open(module.__file__, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+class ReportManifest:
+    def __init__(self, directory: str):
+        """
+        :param directory: Report directory, the manifest is stored in it.
+        """
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST_FILE)
+        self.artifacts = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                self.artifacts = json.load(file)
+        except (OSError, ValueError):
+            pass
+
+    def files(self, name: str) -> list[str]:
+        """
+        Returns the paths of the files recorded for an artifact.
+        """
+        entry = self.artifacts.get(name)
+        return [os.path.join(self.directory, file) for file in entry["files"]] if entry else []
+
+    def fresh(self, name: str, key: str) -> bool:
+        """
+        Tells if the artifact was built from inputs with this hash and all its files still exist.
+        """
+        entry = self.artifacts.get(name)
+        return bool(entry) and entry["key"] == key and all(os.path.exists(path) for path in self.files(name))
+
+    def record(self, name: str, key: str, files: list[str]) -> None:
+        """
+        Records a built artifact and saves the manifest.
+        """
+        self.artifacts[name] = {"key": key, "files": [os.path.relpath(path, self.directory) for path in files]}
+        self.save()
+
+    def save(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(self.artifacts, file, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
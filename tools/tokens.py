@@ -0,0 +1,109 @@
+"""
+Shared token counting and trimming.
+
+Encoders are loaded once per model. Trimming encodes the text a single time and cuts the token array,
+instead of dropping words and re-tokenizing the whole text in a loop.
+"""
+
+import re
+from functools import lru_cache
+import tiktoken
+
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+TRIM_MARKER = "\n...\n"
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = DEFAULT_MODEL) -> tiktoken.Encoding:
+    """
+    Returns the memoized tiktoken encoder of a model.
+    """
+    return tiktoken.encoding_for_model(model)
+
+
+def encode(text: str, model: str = DEFAULT_MODEL) -> list[int]:
+    # special tokens in article text are counted as ordinary text
+    return get_encoding(model).encode(text, disallowed_special=())
+
+
+def decode(tokens: list[int], model: str = DEFAULT_MODEL) -> str:
+    # a cut can split a multi-byte character, drop the replacement character it leaves behind
+    return get_encoding(model).decode(tokens).strip("�")
+
+
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    return len(encode(text, model))
+
+
+def count_tokens_batch(texts: list[str], model: str = DEFAULT_MODEL) -> list[int]:
+    """
+    Counts tokens of several texts in one call, encoding them in parallel threads.
+    """
+    return [len(tokens) for tokens in get_encoding(model).encode_batch(texts, disallowed_special=())]
+
+
+def trim_tokens(text: str, max_tokens: int, model: str = DEFAULT_MODEL, where: str = "tail",
+                marker: str = TRIM_MARKER) -> str:
+    """
+    Trims a text to at most `max_tokens` tokens.
+
+    :param where: "tail" keeps the beginning, "head" keeps the end,
+        "middle" keeps both ends and puts `marker` in place of the removed part.
+    """
+    max_tokens = max(int(max_tokens), 0)
+    tokens = encode(text, model)
+    if len(tokens) <= max_tokens:
+        return text
+
+    if where == "tail":
+        return decode(tokens[:max_tokens], model)
+    if where == "head":
+        return decode(tokens[len(tokens) - max_tokens:], model) if max_tokens else ""
+    if where == "middle":
+        keep = max(max_tokens - count_tokens(marker, model), 0)
+        head = keep - keep // 2
+        tail = keep // 2
+        return decode(tokens[:head], model) + marker + (decode(tokens[-tail:], model) if tail else "")
+    raise ValueError(f"Unknown trimming position: {where}")
+
+
+def split_sections(text: str) -> list[str]:
+    """
+    Splits a markdown text before each heading line.
+    """
+    return [section for section in re.split(r"(?m)^(?=#)", text) if section]
+
+
+def trim_sections(text: str, max_tokens: int, model: str = DEFAULT_MODEL) -> str:
+    """
+    Trims a markdown text to `max_tokens` by cutting the tail of each section.
+    Short sections are kept whole and the remaining budget is shared equally by the long ones.
+    Token counts are additive only approximately, the result can be off by a token at section joins.
+    """
+    sections = split_sections(text)
+    encoded = get_encoding(model).encode_batch(sections, disallowed_special=())
+    if sum(len(tokens) for tokens in encoded) <= max_tokens:
+        return text
+
+    budget = max(int(max_tokens), 0)
+    limits = [0] * len(sections)
+    pending = sorted(range(len(sections)), key=lambda i: len(encoded[i]))
+    while pending:
+        share = budget // len(pending)
+        i = pending[0]
+        if len(encoded[i]) <= share:
+            limits[i] = len(encoded[i])
+            budget -= limits[i]
+            pending.pop(0)
+        else:
+            for i in pending:
+                limits[i] = share
+            break
+
+    return "".join(
+        # one token of a cut section is left for the line break before the next heading
+        section if limits[i] >= len(encoded[i]) else decode(encoded[i][:limits[i] - 1], model).rstrip() + "\n"
+        for i, section in enumerate(sections)
+        if limits[i] > 1 or limits[i] >= len(encoded[i])
+    )